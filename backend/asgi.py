@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded by get_asgi_application
+from simple_music_service.events import RECOGNITION_EVENTS_PATH, recognition_events  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["method"] == "GET":
+        match = RECOGNITION_EVENTS_PATH.match(scope["path"])
+        if match is not None:
+            return await recognition_events(scope, receive, send, int(match["song_id"]))
+    return await django_application(scope, receive, send)
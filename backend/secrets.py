@@ -1,13 +1,111 @@
 import boto3
 import os
 import json
+import time
+import logging
+import threading
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger("django")
+
+_secrets = None
+_loaded_at = None
+_lock = threading.Lock()
 
 
 def get_secret_value(secret_key):
+    return get_secrets()[secret_key]
+
+
+def get_secrets():
+    """Returns the secret bundle, loaded once per process and reloaded every SECRETS_CACHE_TTL seconds (0 never)."""
+    global _secrets, _loaded_at
+    ttl = int(os.environ.get("SECRETS_CACHE_TTL", 60 * 60))
+    if _secrets is None or (ttl and time.monotonic() - _loaded_at > ttl):
+        with _lock:
+            if _secrets is None or (ttl and time.monotonic() - _loaded_at > ttl):
+                try:
+                    _secrets = load_secrets(ttl)
+                except (BotoCoreError, ClientError, OSError, ValueError) as error:
+                    if _secrets is None:
+                        raise
+                    # Values that failed to refresh are still better than failing requests
+                    logger.warning(f"Unable to refresh secrets, keeping the loaded ones: {error}")
+                _loaded_at = time.monotonic()
+    return _secrets
+
+
+def clear_secrets_cache():
+    global _secrets
+    with _lock:
+        _secrets = None
+
+
+def load_secrets(ttl):
+    provider = os.environ.get("SECRETS_PROVIDER", "aws")
+    if provider != "aws":
+        return PROVIDERS[provider]()
+
+    cache_file = os.environ.get("SECRETS_CACHE_FILE")
+    secrets = read_cache_file(cache_file, ttl) if cache_file else None
+    if secrets is None:
+        secrets = get_aws_secrets()
+        if cache_file:
+            write_cache_file(cache_file, secrets)
+    return secrets
+
+
+def get_aws_secrets():
     client = boto3.client(
         service_name="secretsmanager",
         region_name=os.environ["SECRETS_MANAGER_REGION_NAME"]
     )
     response = client.get_secret_value(SecretId=os.environ["SECRET_ID"])
-    secret_values = json.loads(response["SecretString"])
-    return secret_values[secret_key]
+    return json.loads(response["SecretString"])
+
+
+def get_environment_secrets():
+    # Offline runs pass every secret as an environment variable of the same name
+    return dict(os.environ)
+
+
+def get_file_secrets():
+    with open(os.environ["SECRETS_FILE"]) as file:
+        return json.load(file)
+
+
+PROVIDERS = {
+    "aws": get_aws_secrets,
+    "env": get_environment_secrets,
+    "file": get_file_secrets,
+}
+
+
+def read_cache_file(path, ttl):
+    """Returns the secrets of an encrypted cache file written less than ttl seconds ago, None otherwise."""
+    from cryptography.fernet import Fernet, InvalidToken
+    try:
+        with open(path, "rb") as file:
+            token = file.read()
+        return json.loads(Fernet(os.environ["SECRETS_CACHE_KEY"]).decrypt(token, ttl=ttl or None))
+    except FileNotFoundError:
+        return None
+    except OSError as error:
+        logger.warning(f"Unable to read secrets cache file {path}: {error}")
+        return None
+    except InvalidToken:
+        logger.info(f"Secrets cache file {path} is expired or was not encrypted with the current key")
+        return None
+
+
+def write_cache_file(path, secrets):
+    # Processes started next on this host skip the AWS round trip; the key never touches the disk
+    from cryptography.fernet import Fernet
+    token = Fernet(os.environ["SECRETS_CACHE_KEY"]).encrypt(json.dumps(secrets).encode())
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+            file.write(token)
+        os.replace(temporary_path, path)
+    except OSError as error:
+        logger.warning(f"Unable to write secrets cache file {path}: {error}")
@@ -1,5 +1,6 @@
 """Django settings for backend project."""
 import os
+import tempfile
 import boto3
 from pathlib import Path
 from typing import List
@@ -92,6 +93,67 @@ else:
         }
     }
 
+# Cache
+if "REDIS_CACHE_URL" in os.environ:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_CACHE_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+SONG_CACHE_TIMEOUT = int(os.environ.get("SONG_CACHE_TIMEOUT", 15 * 60))
+
+# Without Redis each process keeps its own leaderboards in memory, which only suits a single process: updates and the
+# periodic refresh made by one web process or worker are never seen by the others
+LEADERBOARD_REDIS_URL = os.environ.get("LEADERBOARD_REDIS_URL", os.environ.get("REDIS_CACHE_URL"))
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", 100))
+LEADERBOARD_MIN_RATINGS = int(os.environ.get("LEADERBOARD_MIN_RATINGS", 1))
+
+RECOMMENDATION_NEIGHBOURS = int(os.environ.get("RECOMMENDATION_NEIGHBOURS", 20))
+RECOMMENDATION_BLOCK_SIZE = int(os.environ.get("RECOMMENDATION_BLOCK_SIZE", 256))
+RECOMMENDATION_SIZE = int(os.environ.get("RECOMMENDATION_SIZE", 20))
+
+BULK_UPLOAD_MAX_SONGS = int(os.environ.get("BULK_UPLOAD_MAX_SONGS", 50))
+SONG_UPLOAD_MAX_SIZE = int(os.environ.get("SONG_UPLOAD_MAX_SIZE", 100 * 1024 * 1024))
+SONG_UPLOAD_EXPIRES = int(os.environ.get("SONG_UPLOAD_EXPIRES", 60 * 60))
+UPLOAD_SESSION_BACKEND = os.environ.get("UPLOAD_SESSION_BACKEND",
+                                        "simple_music_service.uploads.S3MultipartUploadBackend")
+UPLOAD_SESSION_DIR = os.environ.get("UPLOAD_SESSION_DIR", os.path.join(tempfile.gettempdir(), "upload_sessions"))
+UPLOAD_CHUNK_MAX_SIZE = int(os.environ.get("UPLOAD_CHUNK_MAX_SIZE", 16 * 1024 * 1024))
+# Sessions idle for longer are aborted by the delete_stale_upload_sessions task
+UPLOAD_SESSION_EXPIRES = int(os.environ.get("UPLOAD_SESSION_EXPIRES", 24 * 60 * 60))
+
+# "redirect" to a short-lived signed URL, "accel" for nginx X-Accel-Redirect or "direct" to serve ranges from Django
+SONG_STREAM_MODE = os.environ.get("SONG_STREAM_MODE", "redirect")
+SONG_STREAM_URL_EXPIRES = int(os.environ.get("SONG_STREAM_URL_EXPIRES", 5 * 60))
+SONG_STREAM_ACCEL_PREFIX = "/protected-songs/"
+
+SONG_RENDITION_BITRATES = [64, 128]
+SONG_HLS_SEGMENT_SECONDS = 10
+
+SONG_WAVEFORM_BUCKETS = 4096
+SONG_WAVEFORM_DEFAULT_BUCKETS = 1024
+SONG_WAVEFORM_MAX_AGE = 24 * 60 * 60
+
+SPEECH_RECOGNITION_WORKERS = int(os.environ.get("SPEECH_RECOGNITION_WORKERS", 8))
+SPEECH_RECOGNITION_TIMEOUT = int(os.environ.get("SPEECH_RECOGNITION_TIMEOUT", 15))
+SPEECH_RECOGNITION_RETRIES = int(os.environ.get("SPEECH_RECOGNITION_RETRIES", 2))
+SPEECH_RECOGNITION_RETRY_DELAY = 1
+SPEECH_RECOGNITION_ENGINE = os.environ.get("SPEECH_RECOGNITION_ENGINE",
+                                           "simple_music_service.recognition.GoogleRecognitionEngine")
+SPEECH_RECOGNITION_BATCH_SIZE = int(os.environ.get("SPEECH_RECOGNITION_BATCH_SIZE", 8))
+VOSK_MODEL_PATH = os.environ.get("VOSK_MODEL_PATH", "/opt/vosk-model")
+# Set on workers consuming the recognition queue only, the others would load models they never use
+SPEECH_RECOGNITION_PRELOAD = os.environ.get("SPEECH_RECOGNITION_PRELOAD") == "true"
+RECOGNITION_EVENTS_POLL_INTERVAL = 1
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -155,22 +217,71 @@ AWS_STORAGE_BUCKET_NAME = os.environ["AWS_STORAGE_BUCKET_NAME"]
 AWS_S3_SIGNATURE_VERSION = "s3v4"
 AWS_S3_REGION_NAME = os.environ["AWS_S3_REGION_NAME"]
 AWS_S3_FILE_OVERWRITE = False
+# Lifetime of the signed URLs in song representations, whose ETags change twice as often
+AWS_QUERYSTRING_EXPIRE = int(os.environ.get("AWS_QUERYSTRING_EXPIRE", 60 * 60))
 AWS_DEFAULT_ACL = "public-read"
 AWS_S3_VERIFY = True
 DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
 
 FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.environ["FILE_UPLOAD_MAX_MEMORY_SIZE"])
+FILE_UPLOAD_HANDLERS = [
+    "simple_music_service.uploads.SHA256MemoryFileUploadHandler",
+    "simple_music_service.uploads.SHA256TemporaryFileUploadHandler",
+]
 
 DATETIME_FORMAT = "iso-8601"
 
+# A LaunchDarkly flag file replaces the LaunchDarkly service for tests and offline runs
+FEATURE_FLAG_FILE = os.environ.get("FEATURE_FLAG_FILE")
+FEATURE_FLAG_CACHE_TTL = int(os.environ.get("FEATURE_FLAG_CACHE_TTL", 30))
+FEATURE_FLAG_START_WAIT = 5
+
 EMAIL_BACKEND = "anymail.backends.sendinblue.EmailBackend"
 ANYMAIL = {
     "SENDINBLUE_API_KEY": get_secret_value("SENDINBLUE_API_KEY")
 }
+EMAIL_OUTBOX_DELAY = int(os.environ.get("EMAIL_OUTBOX_DELAY", 5))
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get("EMAIL_OUTBOX_BATCH_SIZE", 100))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("EMAIL_OUTBOX_MAX_ATTEMPTS", 6))
+EMAIL_OUTBOX_RETRY_DELAY = 30
+EMAIL_OUTBOX_MAX_RETRY_DELAY = 60 * 60
 
 BROKER_URL = "redis://redis:6379"
 CELERY_RESULT_BACKEND = "redis://redis:6379"
 BROKER_TRANSPORT_OPTIONS = {"visibility_timeout": 3600}
+# Every queue has its own workers in docker-compose.yaml, so a burst of one kind of task never delays the others;
+# tasks without a route go to the default "celery" queue
+CELERY_ROUTES = {
+    "simple_music_service.tasks.send_outbox_emails": {"queue": "email"},
+    "simple_music_service.tasks.process_song": {"queue": "media"},
+    "simple_music_service.tasks.extract_song_metadata": {"queue": "media"},
+    "simple_music_service.tasks.transcode_song": {"queue": "media"},
+    "simple_music_service.tasks.compute_song_waveform": {"queue": "media"},
+    "simple_music_service.tasks.recognize_speech_from_file": {"queue": "recognition"},
+}
+CELERYD_PREFETCH_MULTIPLIER = int(os.environ.get("CELERY_PREFETCH_MULTIPLIER", 4))
+# The hard limit stays below the visibility timeout, or the broker would redeliver late acknowledged tasks still running
+RECOGNITION_TASK_SOFT_TIME_LIMIT = int(os.environ.get("RECOGNITION_TASK_SOFT_TIME_LIMIT", 25 * 60))
+RECOGNITION_TASK_TIME_LIMIT = int(os.environ.get("RECOGNITION_TASK_TIME_LIMIT", 30 * 60))
+RECOGNITION_TASK_RATE_LIMIT = os.environ.get("RECOGNITION_TASK_RATE_LIMIT", "10/m")
+CELERYBEAT_SCHEDULE = {
+    "refresh-leaderboards": {
+        "task": "simple_music_service.tasks.refresh_leaderboards",
+        "schedule": timedelta(minutes=5),
+    },
+    "send-outbox-emails": {
+        "task": "simple_music_service.tasks.send_outbox_emails",
+        "schedule": timedelta(minutes=1),
+    },
+    "compute-song-similarities": {
+        "task": "simple_music_service.tasks.compute_song_similarities",
+        "schedule": timedelta(hours=6),
+    },
+    "delete-stale-upload-sessions": {
+        "task": "simple_music_service.tasks.delete_stale_upload_sessions",
+        "schedule": timedelta(hours=1),
+    },
+}
 
 boto3_logs_client = boto3.client("logs", region_name=os.environ["CLOUD_WATCH_REGION_NAME"])
 
@@ -0,0 +1,56 @@
+import hashlib
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+CATALOG_VERSION_KEY = "songs:catalog:version"
+ARTIST_VERSION_KEY = "songs:artists:version"
+SONG_VERSION_KEY = "songs:{song_id}:version"
+
+
+def get_versions(*keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # A fresh version starts from the current time, so entries cached under an evicted version never come back
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(*keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def invalidate_versions(*keys):
+    bump_versions(*keys)
+    # Bump again after commit so responses cached by concurrent readers before the commit are dropped too
+    transaction.on_commit(lambda: bump_versions(*keys))
+
+
+def invalidate_song_cache(*song_ids):
+    song_keys = [SONG_VERSION_KEY.format(song_id=song_id) for song_id in song_ids]
+    invalidate_versions(CATALOG_VERSION_KEY, *song_keys)
+
+
+def invalidate_artist_cache():
+    invalidate_versions(CATALOG_VERSION_KEY, ARTIST_VERSION_KEY)
+
+
+def get_song_list_cache_key(request, **kwargs):
+    return get_request_cache_key("songs:list", request, get_versions(CATALOG_VERSION_KEY))
+
+
+def get_song_detail_cache_key(request, pk=None, **kwargs):
+    versions = get_versions(SONG_VERSION_KEY.format(song_id=pk), ARTIST_VERSION_KEY)
+    return get_request_cache_key(f"songs:detail:{pk}", request, versions)
+
+
+def get_request_cache_key(prefix, request, versions):
+    query_params = sorted(request.query_params.lists())
+    request_hash = hashlib.md5(f"{request.path}?{query_params}".encode()).hexdigest()
+    return f"{prefix}:{':'.join(str(version) for version in versions)}:{request_hash}"
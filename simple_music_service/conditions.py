@@ -0,0 +1,61 @@
+import hashlib
+import time
+from django.conf import settings
+from django.db.models import Count, Max
+from .caches import get_versions, CATALOG_VERSION_KEY, ARTIST_VERSION_KEY, SONG_VERSION_KEY
+from .models import Playlist, Comment, SongWaveform
+
+
+def song_list_etag(request, *args, **kwargs):
+    return get_etag(request, get_signed_url_period(), *get_versions(CATALOG_VERSION_KEY))
+
+
+def song_detail_etag(request, pk=None, **kwargs):
+    versions = get_versions(SONG_VERSION_KEY.format(song_id=pk), ARTIST_VERSION_KEY)
+    return get_etag(request, get_signed_url_period(), *versions)
+
+
+def playlist_list_etag(request, users_pk=None, **kwargs):
+    playlists = Playlist.objects.filter(user=users_pk).aggregate(count=Count("id"), updated=Max("updated_date_time"))
+    versions = get_versions(CATALOG_VERSION_KEY)
+    return get_etag(request, get_signed_url_period(), playlists["count"], playlists["updated"], *versions)
+
+
+def playlist_detail_etag(request, pk=None, users_pk=None, **kwargs):
+    updated = Playlist.objects.filter(pk=pk, user=users_pk).values_list("updated_date_time", flat=True).first()
+    return get_etag(request, get_signed_url_period(), updated, *get_versions(CATALOG_VERSION_KEY))
+
+
+def get_signed_url_period():
+    # Song locations and renditions are signed URLs, so a 304 must not keep a body past their expiry. The ETag
+    # changes every half lifetime, which leaves the cached body valid as long as SONG_CACHE_TIMEOUT is shorter.
+    return int(time.time() // (settings.AWS_QUERYSTRING_EXPIRE // 2))
+
+
+def comment_list_etag(request, songs_pk=None, **kwargs):
+    comments = Comment.objects.filter(song=songs_pk).aggregate(count=Count("id"), updated=Max("updated_date_time"))
+    return get_etag(request, comments["count"], comments["updated"])
+
+
+def comment_detail_etag(request, pk=None, songs_pk=None, **kwargs):
+    return get_etag(request, comment_detail_last_modified(request, pk, songs_pk))
+
+
+def comment_detail_last_modified(request, pk=None, songs_pk=None, **kwargs):
+    return Comment.objects.filter(pk=pk, song=songs_pk).values_list("updated_date_time", flat=True).first()
+
+
+def song_waveform_etag(request, pk=None, **kwargs):
+    updated = SongWaveform.objects.filter(song=pk).values_list("updated_date_time", flat=True).first()
+    if updated is None:
+        return None
+    # Waveforms are the same for every user, so shared caches may reuse them
+    etag_source = f"{request.get_full_path()}:{request.headers.get('Accept', '')}:{updated}"
+    return hashlib.md5(etag_source.encode()).hexdigest()
+
+
+def get_etag(request, *versions):
+    # Representations differ per path, query, negotiated renderer and, through "user_mark", per user
+    etag_source = f"{request.get_full_path()}:{request.accepted_renderer.format}:{request.user.id}:" \
+                  f"{':'.join(str(version) for version in versions)}"
+    return hashlib.md5(etag_source.encode()).hexdigest()
@@ -0,0 +1,82 @@
+import smtplib
+import logging
+from datetime import timedelta
+from anymail.exceptions import AnymailError
+from anymail.message import AnymailMessage
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
+from .models import OutboxEmail
+
+logger = logging.getLogger("django")
+
+MESSAGES = {
+    OutboxEmail.WELCOME: {
+        "subject": "Welcome to Simple music service",
+        "body": "Thank you for creating an account on our service.",
+    },
+}
+THROTTLED_STATUS_CODE = 429
+
+
+def send_outbox_emails():
+    """Sends due outbox emails in batches over one connection and returns the number sent."""
+    sent = 0
+    with get_connection() as connection:
+        while True:
+            with transaction.atomic():
+                # Concurrent runs skip each other's batches instead of sending them twice
+                emails = list(OutboxEmail.objects.select_for_update(skip_locked=True)
+                              .filter(status=OutboxEmail.PENDING, next_attempt_date_time__lte=timezone.now())
+                              .order_by("next_attempt_date_time")[:settings.EMAIL_OUTBOX_BATCH_SIZE])
+                if not emails:
+                    break
+                batch_sent, is_throttled = send_batch(connection, emails)
+            sent += batch_sent
+            if is_throttled or len(emails) < settings.EMAIL_OUTBOX_BATCH_SIZE:
+                break
+    logger.info(f"Sent {sent} outbox emails")
+    return sent
+
+
+def send_batch(connection, emails):
+    now = timezone.now()
+    sent = 0
+    is_throttled = False
+    for email in emails:
+        if is_throttled:
+            # Not this email's fault, so it waits without using up an attempt
+            email.next_attempt_date_time = now + get_retry_delay(1)
+            continue
+        try:
+            connection.send_messages([get_message(email)])
+        except (AnymailError, smtplib.SMTPException, OSError) as error:
+            logger.warning(f"Unable to send outbox email {email.id}: {error}")
+            is_throttled = getattr(error, "status_code", None) == THROTTLED_STATUS_CODE
+            schedule_retry(email, now, str(error))
+        else:
+            email.status = OutboxEmail.SENT
+            email.sent_date_time = now
+            email.error = None
+            sent += 1
+    OutboxEmail.objects.bulk_update(emails, ["status", "attempts", "error", "next_attempt_date_time", "sent_date_time"])
+    return sent, is_throttled
+
+
+def schedule_retry(email, now, error):
+    email.attempts += 1
+    email.error = error
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmail.FAILED
+    else:
+        email.next_attempt_date_time = now + get_retry_delay(email.attempts)
+
+
+def get_retry_delay(attempts):
+    delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.EMAIL_OUTBOX_MAX_RETRY_DELAY))
+
+
+def get_message(email):
+    return AnymailMessage(to=[email.to], **MESSAGES[email.kind])
@@ -0,0 +1,89 @@
+import asyncio
+import re
+from io import BytesIO
+import orjson
+from asgiref.sync import sync_to_async
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse
+from .models import Song, RecognitionJob, RecognitionChunk
+
+RECOGNITION_EVENTS_PATH = re.compile(r"^/songs/(?P<song_id>\d+)/recognize_speech/events/$")
+FINAL_STATUSES = (RecognitionJob.DONE, RecognitionJob.FAILED)
+
+
+def get_recognition_state(song_id, next_index):
+    """Returns the job's status and progress with its chunks from next_index on, None for songs never recognized."""
+    song = Song.objects.filter(id=song_id).values("lyrics").first()
+    if song is None:
+        return None
+    job = RecognitionJob.objects.filter(song=song_id).values("id", "status", "progress").first()
+    if job is None:
+        if song["lyrics"] is None:
+            return None
+        return {"status": RecognitionJob.DONE, "progress": 100, "chunks": [], "lyrics": song["lyrics"]}
+    chunks = RecognitionChunk.objects.filter(job=job["id"], index__gte=next_index).values("index", "text", "end_time")
+    return {"status": job["status"], "progress": job["progress"], "chunks": list(chunks), "lyrics": song["lyrics"]}
+
+
+async def recognition_events(scope, receive, send, song_id):
+    """Streams a song's recognition as Server-Sent Events: "chunk" for every partial result, "progress" on every poll
+    and a final "done" or "failed" event with the lyrics.
+
+    This is a plain ASGI handler, since Django 4.0 iterates streaming responses synchronously, and waiting clients
+    would each hold a thread.
+    """
+    cors_headers = get_cors_headers(scope)
+    state = await sync_to_async(get_recognition_state)(song_id, 0)
+    if state is None:
+        await send_json_response(send, 404, {"detail": "Not found."}, cors_headers)
+        return
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"), *cors_headers],
+    })
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    next_index = 0
+    try:
+        while state is not None:
+            for chunk in state["chunks"]:
+                await send_event(send, "chunk", chunk)
+                next_index = chunk["index"] + 1
+            await send_event(send, "progress", {"status": state["status"], "progress": state["progress"]})
+            if state["status"] in FINAL_STATUSES:
+                await send_event(send, state["status"], {"lyrics": state["lyrics"]})
+                break
+            await asyncio.wait([disconnected], timeout=settings.RECOGNITION_EVENTS_POLL_INTERVAL)
+            if disconnected.done():
+                return
+            state = await sync_to_async(get_recognition_state)(song_id, next_index)
+    finally:
+        disconnected.cancel()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def get_cors_headers(scope):
+    """Returns the CORS headers CorsMiddleware would add, which never sees requests bypassing Django."""
+    response = CorsMiddleware(lambda request: None).process_response(ASGIRequest(scope, BytesIO()), HttpResponse())
+    return [(name.lower().encode(), value.encode()) for name, value in response.items()
+            if name.lower().startswith("access-control-") or name.lower() == "vary"]
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_event(send, name, data):
+    body = b"event: " + name.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+    await send({"type": "http.response.body", "body": body, "more_body": True})
+
+
+async def send_json_response(send, status, data, headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), *headers]})
+    await send({"type": "http.response.body", "body": orjson.dumps(data)})
@@ -1,14 +1,63 @@
 import os
-import ldclient
+import time
+import threading
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from ldclient.client import LDClient
 from ldclient.config import Config
+from ldclient.integrations import Files
 from backend.secrets import get_secret_value
 
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+# Flag id -> (value, monotonic expiry time)
+_values = {}
 
-def get_feature_flag_value(flag_id):
-    server_side_key = get_secret_value("LAUNCH_DARKLY_SERVER_SIDE_KEY")
-    ldclient.set_config(Config(server_side_key))
 
-    with ldclient.get() as client:
-        user = {"key": os.environ["LAUNCH_DARKLY_KEY"]}
-        feature_flag_value = client.variation(flag_id, user, False)
-        return feature_flag_value
+def get_feature_flag_value(flag_id, default=False):
+    """Evaluates a flag for this service. The SDK keeps its flag store up to date from a background stream, and
+    evaluations are cached for FEATURE_FLAG_CACHE_TTL seconds on top of it."""
+    now = time.monotonic()
+    cached = _values.get(flag_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    value = get_client().variation(flag_id, {"key": os.environ["LAUNCH_DARKLY_KEY"]}, default)
+    _values[flag_id] = (value, now + settings.FEATURE_FLAG_CACHE_TTL)
+    return value
+
+
+def get_client():
+    global _client, _client_pid
+    # The SDK's streaming thread does not survive forking, so every worker process starts its own client
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = LDClient(get_config(), start_wait=settings.FEATURE_FLAG_START_WAIT)
+                _client_pid = os.getpid()
+                _values.clear()
+    return _client
+
+
+def get_config():
+    if settings.FEATURE_FLAG_FILE:
+        # Local flag values for tests and offline runs, reloaded when the file changes
+        data_source = Files.new_data_source(paths=[settings.FEATURE_FLAG_FILE], auto_update=True)
+        return Config("local", update_processor_class=data_source, send_events=False, diagnostic_opt_out=True)
+    return Config(get_secret_value("LAUNCH_DARKLY_SERVER_SIDE_KEY"))
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _values.clear()
+
+
+@receiver(setting_changed)
+def reset_feature_flags(setting, **kwargs):
+    if setting.startswith("FEATURE_FLAG_"):
+        close_client()
@@ -1,4 +1,6 @@
-from rest_framework.filters import OrderingFilter
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import FloatField, IntegerField
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
 from django.db.models import F
 
 
@@ -12,3 +14,31 @@ class NotNoneValuesLargerOrderingFilter(OrderingFilter):
                 else queryset.order_by(F(order).asc(nulls_first=True))
 
         return queryset
+
+
+class SongMetadataFilter(BaseFilterBackend):
+    # Query parameter: (lookup, parsing field, multiplier to the stored unit); durations are given in seconds
+    parameters = {
+        "min_duration": ("duration__gte", FloatField(min_value=0), 1000),
+        "max_duration": ("duration__lte", FloatField(min_value=0), 1000),
+        "min_bitrate": ("bitrate__gte", IntegerField(min_value=0), 1),
+        "max_bitrate": ("bitrate__lte", IntegerField(min_value=0), 1),
+        "channels": ("channels", IntegerField(min_value=1), 1),
+        "min_size": ("size__gte", IntegerField(min_value=0), 1),
+        "max_size": ("size__lte", IntegerField(min_value=0), 1),
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        lookups = {}
+        errors = {}
+        for parameter, (lookup, field, multiplier) in self.parameters.items():
+            value = request.query_params.get(parameter)
+            if value is None:
+                continue
+            try:
+                lookups[lookup] = round(field.run_validation(value) * multiplier)
+            except ValidationError as error:
+                errors[parameter] = error.detail
+        if errors:
+            raise ValidationError(errors)
+        return queryset.filter(**lookups) if lookups else queryset
@@ -0,0 +1,196 @@
+import logging
+import threading
+from datetime import timedelta
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count
+from django.utils import timezone
+from simple_music_service import models
+
+logger = logging.getLogger("django")
+
+TOP_RATED = "top_rated"
+TRENDING_WINDOWS = {
+    "trending_day": timedelta(days=1),
+    "trending_week": timedelta(days=7),
+}
+LEADERBOARDS = [TOP_RATED, *TRENDING_WINDOWS]
+
+LEADERBOARD_KEY = "leaderboards:{name}"
+LEADERBOARD_BUILT_KEY = "leaderboards:{name}:built"
+
+
+class RedisSortedSetStore:
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+
+    def exists(self, name):
+        return bool(self.client.exists(LEADERBOARD_BUILT_KEY.format(name=name)))
+
+    def set_score(self, name, member, score):
+        self.client.zadd(LEADERBOARD_KEY.format(name=name), {member: score})
+
+    def increment(self, name, member, amount=1):
+        self.client.zincrby(LEADERBOARD_KEY.format(name=name), amount, member)
+
+    def remove(self, name, member):
+        self.client.zrem(LEADERBOARD_KEY.format(name=name), member)
+
+    def replace(self, name, scores):
+        key = LEADERBOARD_KEY.format(name=name)
+        with self.client.pipeline(transaction=True) as pipeline:
+            pipeline.delete(key)
+            if scores:
+                pipeline.zadd(key, scores)
+            pipeline.set(LEADERBOARD_BUILT_KEY.format(name=name), timezone.now().isoformat())
+            pipeline.execute()
+
+    def top(self, name, count):
+        members = self.client.zrevrange(LEADERBOARD_KEY.format(name=name), 0, count - 1, withscores=True)
+        return [(int(member), score) for member, score in members]
+
+
+class LocalSortedSetStore:
+    """In-process stand-in for RedisSortedSetStore, used when no Redis server is configured."""
+
+    def __init__(self):
+        self.sets = {}
+        self.built = set()
+        self.lock = threading.Lock()
+
+    def exists(self, name):
+        return name in self.built
+
+    def set_score(self, name, member, score):
+        with self.lock:
+            self.sets.setdefault(name, {})[member] = score
+
+    def increment(self, name, member, amount=1):
+        with self.lock:
+            scores = self.sets.setdefault(name, {})
+            scores[member] = scores.get(member, 0) + amount
+
+    def remove(self, name, member):
+        with self.lock:
+            self.sets.get(name, {}).pop(member, None)
+
+    def replace(self, name, scores):
+        with self.lock:
+            self.sets[name] = dict(scores)
+            self.built.add(name)
+
+    def top(self, name, count):
+        with self.lock:
+            scores = list(self.sets.get(name, {}).items())
+        return get_top_scores(scores, count)
+
+
+def get_top_scores(scores, count):
+    # Highest score first, like ZREVRANGE
+    return sorted(scores, key=lambda item: (item[1], item[0]), reverse=True)[:count]
+
+
+_store = None
+
+
+def get_leaderboard_store():
+    global _store
+    if _store is None:
+        if settings.LEADERBOARD_REDIS_URL:
+            _store = RedisSortedSetStore(settings.LEADERBOARD_REDIS_URL)
+        else:
+            _store = LocalSortedSetStore()
+    return _store
+
+
+def get_leaderboard(name, count):
+    store = get_leaderboard_store()
+    try:
+        if not store.exists(name):
+            refresh_leaderboard(name)
+        return store.top(name, count)
+    except redis.RedisError as error:
+        # Slower, but the leaderboard stays available while Redis is not
+        logger.warning(f"Unable to read leaderboard {name} from Redis, computing it from the database: {error}")
+        return get_top_scores(get_scores(name).items(), count)
+
+
+def refresh_leaderboards():
+    for name in LEADERBOARDS:
+        refresh_leaderboard(name)
+
+
+def refresh_leaderboard(name):
+    get_leaderboard_store().replace(name, get_scores(name))
+
+
+def get_scores(name):
+    if name == TOP_RATED:
+        return get_top_rated_scores()
+    return get_trending_scores(TRENDING_WINDOWS[name])
+
+
+def get_top_rated_scores(song_ids=None):
+    ratings = models.Rating.objects.all()
+    if song_ids is not None:
+        ratings = ratings.filter(song__in=song_ids)
+    ratings = ratings.values("song").annotate(average=Avg("mark"), count=Count("id")) \
+        .filter(count__gte=settings.LEADERBOARD_MIN_RATINGS)
+    return {rating["song"]: float(rating["average"]) for rating in ratings}
+
+
+def get_trending_scores(window):
+    since = timezone.now() - window
+    scores = {}
+    ratings = models.Rating.objects.filter(updated_date_time__gte=since).values("song").annotate(count=Count("id"))
+    comments = models.Comment.objects.filter(created_date_time__gte=since).values("song").annotate(count=Count("id"))
+    for activity in [*ratings, *comments]:
+        scores[activity["song"]] = scores.get(activity["song"], 0) + activity["count"]
+    return scores
+
+
+def update_on_commit(update):
+    def run():
+        try:
+            update()
+        except redis.RedisError as error:
+            # The write has already been committed, so the periodic refresh_leaderboards repairs the scores
+            logger.warning(f"Unable to update leaderboards: {error}")
+
+    transaction.on_commit(run)
+
+
+def update_song_ratings(*song_ids):
+    # Nested views assign URL kwargs, so ids may arrive as strings
+    song_ids = [int(song_id) for song_id in song_ids]
+
+    def update():
+        store = get_leaderboard_store()
+        scores = get_top_rated_scores(song_ids)
+        for song_id in song_ids:
+            if song_id in scores:
+                store.set_score(TOP_RATED, song_id, scores[song_id])
+            else:
+                store.remove(TOP_RATED, song_id)
+
+    update_on_commit(update)
+
+
+def record_song_activity(song_id):
+    # Window boards only grow between refreshes; the periodic rebuild drops activity that left the window
+    def record():
+        store = get_leaderboard_store()
+        for name in TRENDING_WINDOWS:
+            store.increment(name, int(song_id))
+
+    update_on_commit(record)
+
+
+def remove_song(song_id):
+    def remove():
+        store = get_leaderboard_store()
+        for name in LEADERBOARDS:
+            store.remove(name, song_id)
+
+    update_on_commit(remove)
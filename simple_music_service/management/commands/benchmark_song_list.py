@@ -0,0 +1,34 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+from simple_music_service.models import ApplicationUser
+from simple_music_service.views import SongViewSet
+
+
+class Command(BaseCommand):
+    help = "Compares requests per second of the serializer and the fast song list paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=50)
+        parser.add_argument("--page-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        # Authenticated requests bypass the response cache, so every request builds the page
+        user = ApplicationUser.objects.first()
+        if user is None:
+            raise CommandError("At least one user is required to run the benchmark")
+
+        views = {
+            "serializer": SongViewSet.as_view({"get": "list"}, use_fast_list=False, renderer_classes=[JSONRenderer]),
+            "fast": SongViewSet.as_view({"get": "list"}),
+        }
+        factory = APIRequestFactory()
+        for name, view in views.items():
+            started = time.perf_counter()
+            for _ in range(options["requests"]):
+                request = factory.get("/songs/", {"page_size": options["page_size"]})
+                force_authenticate(request, user)
+                view(request).render()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{name}: {options['requests'] / elapsed:.1f} requests/s")
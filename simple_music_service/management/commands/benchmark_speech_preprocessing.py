@@ -0,0 +1,49 @@
+import time
+from io import BytesIO
+import numpy as np
+from django.core.management.base import BaseCommand
+from pydub import AudioSegment
+from speech_recognition import AudioFile, Recognizer
+from simple_music_service.recognition import (SAMPLE_RATE, SAMPLE_WIDTH, NoiseFloorTracker, get_audio_data,
+                                              get_frame_levels, normalize_samples)
+
+
+class Command(BaseCommand):
+    help = "Compares CPU time per minute of audio of the WAV round trip and the NumPy speech preprocessing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--minutes", type=int, default=5)
+        parser.add_argument("--chunk-size", type=int, default=6000)
+
+    def handle(self, *args, **options):
+        time_points = np.arange(options["minutes"] * 60 * SAMPLE_RATE) / SAMPLE_RATE
+        samples = (np.sin(2 * np.pi * 220 * time_points) * 8000
+                   + np.random.default_rng(0).normal(0, 200, len(time_points))).astype(np.int16)
+        chunk_length = SAMPLE_RATE * options["chunk_size"] // 1000
+        chunks = [samples[index:index + chunk_length] for index in range(0, len(samples), chunk_length)]
+        sound = AudioSegment(data=samples.tobytes(), sample_width=SAMPLE_WIDTH, frame_rate=SAMPLE_RATE, channels=1)
+
+        def prepare_with_wav_round_trip():
+            # The previous preprocessing: silence pads, a WAV export and an ambient noise pass per chunk
+            recognizer = Recognizer()
+            for index in range(0, len(sound), options["chunk_size"]):
+                chunk = sound[index:index + options["chunk_size"]]
+                chunk_silent = AudioSegment.silent(duration=10, frame_rate=SAMPLE_RATE)
+                with BytesIO() as memory_buffer:
+                    (chunk_silent + chunk + chunk_silent).export(memory_buffer, format="wav")
+                    with AudioFile(memory_buffer) as source:
+                        recognizer.adjust_for_ambient_noise(source)
+                        recognizer.record(source)
+
+        def prepare_with_numpy():
+            # What get_audio_chunks does with every chunk
+            noise_floor = NoiseFloorTracker()
+            for chunk in chunks:
+                noise_floor.update(get_frame_levels(chunk))
+                get_audio_data(normalize_samples(chunk, noise_floor.level))
+
+        for name, prepare in [("wav", prepare_with_wav_round_trip), ("numpy", prepare_with_numpy)]:
+            started = time.process_time()
+            prepare()
+            elapsed = time.process_time() - started
+            self.stdout.write(f"{name}: {elapsed / options['minutes'] * 1000:.1f} ms of CPU time per minute of audio")
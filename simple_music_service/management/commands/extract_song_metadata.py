@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from simple_music_service.models import Song
+from simple_music_service.metadata import extract_song_metadata
+from simple_music_service.tasks import extract_song_metadata as extract_song_metadata_task
+
+
+class Command(BaseCommand):
+    help = "Backfills duration, bitrate, sample rate, channels and size of songs uploaded before metadata extraction"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Re-extract metadata of songs that already have it")
+        parser.add_argument("--queue", action="store_true", help="Send the songs to the workers instead")
+
+    def handle(self, *args, **options):
+        songs = Song.objects.all() if options["all"] else Song.objects.filter(duration__isnull=True)
+        song_ids = list(songs.order_by("id").values_list("id", flat=True))
+        extracted = 0
+        for song_id in song_ids:
+            if options["queue"]:
+                extract_song_metadata_task.delay(song_id)
+            elif extract_song_metadata(song_id) is not None:
+                extracted += 1
+        if options["queue"]:
+            self.stdout.write(f"Queued {len(song_ids)} songs")
+        else:
+            self.stdout.write(f"Extracted metadata of {extracted} of {len(song_ids)} songs")
@@ -0,0 +1,87 @@
+import io
+import logging
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+from .models import Song
+from .streaming import STREAM_BLOCK_SIZE, read_range
+
+logger = logging.getLogger("django")
+
+METADATA_FIELDS = ["duration", "bitrate", "sample_rate", "channels", "size"]
+
+
+class StorageRangeFile(io.RawIOBase):
+    """Read-only file over a stored object that downloads only the byte ranges a reader asks for."""
+
+    def __init__(self, storage, name):
+        super().__init__()
+        self.storage = storage
+        self.name = name
+        self.size = storage.size(name)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size) - 1
+        if end < self.position:
+            return 0
+        data = b"".join(read_range(self.storage, self.name, self.position, end))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_song_file(song):
+    storage = song.location.storage
+    if hasattr(storage, "bucket"):
+        # The S3 storage file downloads the whole object on first read, while mutagen only needs the tags and headers
+        return io.BufferedReader(StorageRangeFile(storage, song.location.name), STREAM_BLOCK_SIZE)
+    return song.location.open("rb")
+
+
+def read_audio_metadata(file):
+    info = MP3(file).info
+    return {
+        "duration": round(info.length * 1000),
+        "bitrate": round(info.bitrate / 1000),
+        "sample_rate": info.sample_rate,
+        "channels": info.channels,
+    }
+
+
+def extract_song_metadata(song_id):
+    try:
+        song = Song.objects.get(id=song_id)
+    except Song.DoesNotExist:
+        logger.info(f"Song {song_id} was deleted before extracting its metadata")
+        return None
+
+    # Songs sharing identical audio have identical metadata
+    metadata = Song.objects.filter(audio=song.audio_id, duration__isnull=False).exclude(id=song.id) \
+        .values(*METADATA_FIELDS).first() if song.audio_id else None
+    if metadata is None:
+        with open_song_file(song) as file:
+            try:
+                metadata = read_audio_metadata(file)
+            except MutagenError as error:
+                logger.warning(f"Unable to read metadata of song {song_id}: {error}")
+                return None
+            metadata["size"] = file.seek(0, io.SEEK_END)
+
+    for field, value in metadata.items():
+        setattr(song, field, value)
+    song.save(update_fields=METADATA_FIELDS)
+    return metadata
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0010_applicationuser_alter_comment_user_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='updated_date_time',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='playlist',
+            name='updated_date_time',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
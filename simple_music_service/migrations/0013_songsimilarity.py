@@ -0,0 +1,27 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0012_rating_updated_date_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('similar_song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='simple_music_service.song')),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='simple_music_service.song')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='songsimilarity',
+            index=models.Index(fields=['song', '-score'], name='song_similarity_score_idx'),
+        ),
+    ]
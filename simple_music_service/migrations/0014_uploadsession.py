@@ -0,0 +1,30 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0013_songsimilarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('key', models.CharField(max_length=100)),
+                ('upload_id', models.CharField(max_length=1024, null=True)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('parts', models.JSONField(default=list)),
+                ('is_completed', models.BooleanField(default=False)),
+                ('created_date_time', models.DateTimeField(auto_now_add=True)),
+                ('updated_date_time', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='simple_music_service.applicationuser')),
+            ],
+        ),
+    ]
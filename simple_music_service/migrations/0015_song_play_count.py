@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0014_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='play_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
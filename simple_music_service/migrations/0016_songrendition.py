@@ -0,0 +1,29 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import simple_music_service.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0015_song_play_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(choices=[('mp3', 'MP3'), ('hls', 'HLS')], max_length=3)),
+                ('bitrate', models.PositiveIntegerField()),
+                ('location', models.FileField(max_length=255, upload_to='')),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='simple_music_service.song')),
+            ],
+            options={
+                'ordering': ['format', 'bitrate'],
+            },
+            bases=(simple_music_service.models.SongCacheMixin, models.Model),
+        ),
+    ]
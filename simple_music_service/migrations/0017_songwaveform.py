@@ -0,0 +1,24 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0016_songrendition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongWaveform',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('duration', models.PositiveIntegerField()),
+                ('peaks', models.BinaryField()),
+                ('updated_date_time', models.DateTimeField(auto_now=True)),
+                ('song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='waveform', to='simple_music_service.song')),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0017_songwaveform'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='bitrate',
+            field=models.PositiveIntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='channels',
+            field=models.PositiveSmallIntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='duration',
+            field=models.PositiveIntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='sample_rate',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='size',
+            field=models.PositiveBigIntegerField(db_index=True, null=True),
+        ),
+    ]
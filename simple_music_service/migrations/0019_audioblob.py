@@ -0,0 +1,30 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0018_song_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('location', models.FileField(max_length=255, upload_to='')),
+                ('size', models.PositiveBigIntegerField()),
+                ('lyrics', models.TextField(null=True)),
+                ('created_date_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='audio',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='songs', to='simple_music_service.audioblob'),
+        ),
+    ]
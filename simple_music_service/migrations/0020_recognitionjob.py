@@ -0,0 +1,27 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0019_audioblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecognitionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=7)),
+                ('task_id', models.CharField(max_length=255, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+                ('created_date_time', models.DateTimeField(auto_now_add=True)),
+                ('updated_date_time', models.DateTimeField(auto_now=True)),
+                ('song', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='recognition_job', to='simple_music_service.song')),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0020_recognitionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recognitionjob',
+            name='progress',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name='RecognitionChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('text', models.TextField(null=True)),
+                ('end_time', models.PositiveIntegerField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='simple_music_service.recognitionjob')),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='recognitionchunk',
+            constraint=models.UniqueConstraint(fields=('job', 'index'), name='recognition_chunk_index_unique'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.0.10 on 2026-10-19 14:58
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0021_recognitionchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('welcome', 'Welcome')], max_length=20)),
+                ('to', models.EmailField(max_length=254)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+                ('next_attempt_date_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_date_time', models.DateTimeField(null=True)),
+                ('created_date_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxemail',
+            index=models.Index(fields=['status', 'next_attempt_date_time'], name='outbox_email_due_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-19 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_music_service', '0022_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='upload_key',
+            field=models.CharField(max_length=100, null=True, unique=True),
+        ),
+    ]
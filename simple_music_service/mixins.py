@@ -1,5 +1,12 @@
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
 from simple_music_service import serializers
 from .models import Rating
+from .caches import get_song_list_cache_key, get_song_detail_cache_key
+from .representations import get_song_representation_fields, get_song_rows, get_song_representations
 
 
 class UserMarkMixin:
@@ -11,3 +18,69 @@ class UserMarkMixin:
                 return serializers.RatingSerializer().to_representation(user_mark)
             except Rating.DoesNotExist:
                 return None
+
+
+class SparseFieldsetMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is not None:
+            sparse_fields = get_sparse_fields(request, self.fields.keys())
+            for field_name in list(self.fields.keys()):
+                if field_name not in sparse_fields:
+                    self.fields.pop(field_name)
+
+
+def get_sparse_fields(request, field_names):
+    sparse_fields = list(field_names)
+    if request.method not in SAFE_METHODS:
+        return sparse_fields
+
+    fields = request.query_params.get("fields")
+    omit = request.query_params.get("omit")
+    if fields:
+        requested_fields = fields.split(",")
+        sparse_fields = [field_name for field_name in sparse_fields if field_name in requested_fields]
+    if omit:
+        omitted_fields = omit.split(",")
+        sparse_fields = [field_name for field_name in sparse_fields if field_name not in omitted_fields]
+    return sparse_fields
+
+
+class SongResponseCacheMixin:
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(get_song_list_cache_key, super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(get_song_detail_cache_key, super().retrieve, request, *args, **kwargs)
+
+    @staticmethod
+    def get_cached_response(get_cache_key, get_response, request, *args, **kwargs):
+        # Authenticated responses carry the per-user "user_mark", so only anonymous ones are shared
+        if request.user.is_authenticated:
+            return get_response(request, *args, **kwargs)
+
+        cache_key = get_cache_key(request, **kwargs)
+        data = cache.get(cache_key)
+        if data is not None:
+            return Response(data)
+
+        response = get_response(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(cache_key, response.data, settings.SONG_CACHE_TIMEOUT)
+        return response
+
+
+class SongFastListMixin:
+    use_fast_list = True
+
+    def list(self, request, *args, **kwargs):
+        if not self.use_fast_list:
+            return super().list(request, *args, **kwargs)
+
+        fields = get_song_representation_fields(get_sparse_fields(request, serializers.SongSerializer.Meta.fields))
+        rows = get_song_rows(self.filter_queryset(self.get_queryset()), fields)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(get_song_representations(page, fields, request))
+        return Response(get_song_representations(rows, fields, request))
@@ -1,7 +1,15 @@
-from django.db import models
+import os
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.core.validators import FileExtensionValidator, MinValueValidator, MaxValueValidator
-from django_lifecycle import hook, LifecycleModelMixin, AFTER_CREATE, AFTER_UPDATE, BEFORE_DELETE
+from django_lifecycle import hook, LifecycleModelMixin, AFTER_CREATE, AFTER_UPDATE, AFTER_SAVE, BEFORE_DELETE
+from .caches import invalidate_song_cache, invalidate_artist_cache
+from .leaderboards import update_song_ratings, record_song_activity, remove_song
+from backend.celery import app
 import logging
 
 logger = logging.getLogger("django")
@@ -89,17 +97,100 @@ class DatabaseAuditMixin(LifecycleModelMixin):
         DatabaseAudit.objects.create(table=table, record_id=record_id, column_name=column_name,
                                      old_value=old_value, new_value=new_value)
 
+    @staticmethod
+    def bulk_save_created_audit_data(instances):
+        # bulk_create skips lifecycle hooks, so record what _after_create_hook would have in a single insert
+        DatabaseAudit.objects.bulk_create(
+            DatabaseAudit(table=instance._meta.db_table, record_id=instance.id, column_name=field.column,
+                          new_value=getattr(instance, field.column))
+            for instance in instances
+            for field in instance._meta.concrete_fields
+        )
+
+
+class SongCacheMixin(LifecycleModelMixin):
+    song_cache_field = "song_id"
+
+    @hook(AFTER_SAVE)
+    @hook(BEFORE_DELETE)
+    def _invalidate_song_cache_hook(self):
+        song_ids = {getattr(self, self.song_cache_field), self.initial_value(self.song_cache_field)}
+        invalidate_song_cache(*(song_id for song_id in song_ids if song_id is not None))
+
+
+class ArtistCacheMixin(LifecycleModelMixin):
+    @hook(AFTER_SAVE)
+    @hook(BEFORE_DELETE)
+    def _invalidate_artist_cache_hook(self):
+        invalidate_artist_cache()
+
+
+class SongLeaderboardMixin(LifecycleModelMixin):
+    @hook(BEFORE_DELETE)
+    def _remove_from_leaderboards_hook(self):
+        remove_song(self.id)
+
+
+class RatingLeaderboardMixin(LifecycleModelMixin):
+    @hook(AFTER_SAVE)
+    def _rating_saved_leaderboard_hook(self):
+        song_ids = {self.song_id, self.initial_value("song_id")}
+        update_song_ratings(*(song_id for song_id in song_ids if song_id is not None))
+        record_song_activity(self.song_id)
+
+    @hook(BEFORE_DELETE)
+    def _rating_deleted_leaderboard_hook(self):
+        update_song_ratings(self.song_id)
+
+
+class CommentLeaderboardMixin(LifecycleModelMixin):
+    @hook(AFTER_CREATE)
+    def _comment_created_leaderboard_hook(self):
+        record_song_activity(self.song_id)
+
+
+class SongProcessingMixin(LifecycleModelMixin):
+    @hook(AFTER_CREATE)
+    def _schedule_processing_hook(self):
+        schedule_song_processing(self.id)
+
+
+def schedule_song_processing(song_id):
+    # Sent by name because tasks.py imports this module
+    transaction.on_commit(lambda: app.send_task("simple_music_service.tasks.process_song", args=[song_id]))
+
 
 class ApplicationUser(DatabaseAuditMixin, User):
     class Meta:
         proxy = True
 
 
-class Artist(DatabaseAuditMixin, models.Model):
+class Artist(DatabaseAuditMixin, ArtistCacheMixin, models.Model):
     name = models.CharField(max_length=50, unique=True)
 
 
-class Song(DatabaseAuditMixin, models.Model):
+class AudioBlob(models.Model):
+    """Uploaded audio stored once per content; songs with identical files share it and its derived results."""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    location = models.FileField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    lyrics = models.TextField(null=True)
+    created_date_time = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def release(cls, audio_id):
+        """Deletes the blob once no song references it and returns whether its file is no longer used."""
+        audio = cls.objects.select_for_update().filter(id=audio_id).first()
+        if audio is None or audio.songs.exists():
+            return False
+        audio.delete()
+        return True
+
+
+class Song(DatabaseAuditMixin, SongCacheMixin, SongLeaderboardMixin, SongProcessingMixin, models.Model):
+    song_cache_field = "id"
+
     title = models.CharField(max_length=50)
     artist = models.ManyToManyField(Artist)
     year = models.DateField()
@@ -107,43 +198,184 @@ class Song(DatabaseAuditMixin, models.Model):
         validators=[FileExtensionValidator(allowed_extensions=["mp3"])]
     )
     user = models.ForeignKey(ApplicationUser, on_delete=models.CASCADE)
+    audio = models.ForeignKey(AudioBlob, on_delete=models.PROTECT, null=True, related_name="songs")
+    # Key of the direct upload the song was finalized from, which can only be finalized once
+    upload_key = models.CharField(max_length=100, null=True, unique=True)
     lyrics = models.TextField(null=True)
+    play_count = models.PositiveBigIntegerField(default=0)
+    duration = models.PositiveIntegerField(null=True, db_index=True)
+    bitrate = models.PositiveIntegerField(null=True, db_index=True)
+    sample_rate = models.PositiveIntegerField(null=True)
+    channels = models.PositiveSmallIntegerField(null=True, db_index=True)
+    size = models.PositiveBigIntegerField(null=True, db_index=True)
 
     @property
     def average_rating(self):
+        if hasattr(self, "avg_rating"):
+            return self.avg_rating
         return self.rating_set.aggregate(models.Avg("mark"))["mark__avg"]
 
     @property
     def reviews_count(self):
+        if hasattr(self, "rating_count"):
+            return self.rating_count
         return self.rating_set.count()
 
     def delete(self, using=None, keep_parents=False):
-        super().delete()
-        self.location.delete(save=False)
+        renditions = list(self.renditions.all())
+        with transaction.atomic():
+            # process_song may have moved a direct upload to its blob since this instance was loaded
+            current = Song.objects.select_for_update().filter(id=self.id).values("audio_id", "location").first()
+            if current is not None:
+                self.audio_id = current["audio_id"]
+                self.location.name = current["location"]
+            super().delete()
+            # Songs uploaded before deduplication own their file, the others share it through the blob
+            is_location_unused = self.audio_id is None or AudioBlob.release(self.audio_id)
+        if is_location_unused:
+            self.location.delete(save=False)
+        for rendition in renditions:
+            rendition.delete_files()
+
+
+class SongRendition(SongCacheMixin, models.Model):
+    MP3 = "mp3"
+    HLS = "hls"
+    FORMAT_CHOICES = [(MP3, "MP3"), (HLS, "HLS")]
+
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="renditions")
+    format = models.CharField(max_length=3, choices=FORMAT_CHOICES)
+    bitrate = models.PositiveIntegerField()
+    location = models.FileField(max_length=255)
+
+    class Meta:
+        ordering = ["format", "bitrate"]
+
+    def delete_files(self):
+        # Songs with identical audio share renditions, whose files go with the last of them
+        if SongRendition.objects.filter(location=self.location.name).exists():
+            return
+        if self.format == self.HLS:
+            storage = self.location.storage
+            directory = os.path.dirname(self.location.name)
+            for file_name in storage.listdir(directory)[1]:
+                storage.delete(f"{directory}/{file_name}")
+        else:
+            self.location.delete(save=False)
 
 
 class Playlist(DatabaseAuditMixin, models.Model):
     title = models.CharField(max_length=50)
     user = models.ForeignKey(ApplicationUser, on_delete=models.CASCADE)
     song = models.ManyToManyField(Song)
+    updated_date_time = models.DateTimeField(auto_now=True)
 
 
-class Rating(DatabaseAuditMixin, models.Model):
+class Rating(DatabaseAuditMixin, SongCacheMixin, RatingLeaderboardMixin, models.Model):
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     user = models.ForeignKey(ApplicationUser, on_delete=models.CASCADE)
     mark = models.IntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(5)]
     )
+    updated_date_time = models.DateTimeField(auto_now=True)
 
     class Meta:
         constraints = [models.UniqueConstraint(fields=["song", "user"], name="unique_song_user_rate")]
 
 
-class Comment(DatabaseAuditMixin, models.Model):
+class Comment(DatabaseAuditMixin, SongCacheMixin, CommentLeaderboardMixin, models.Model):
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     user = models.ForeignKey(ApplicationUser, null=True, on_delete=models.SET_NULL)
     message = models.CharField(max_length=100)
     created_date_time = models.DateTimeField(auto_now_add=True)
+    updated_date_time = models.DateTimeField(auto_now=True)
+
+
+class SongWaveform(models.Model):
+    song = models.OneToOneField(Song, on_delete=models.CASCADE, related_name="waveform")
+    duration = models.PositiveIntegerField()
+    # Interleaved int8 min/max pairs, one pair per bucket
+    peaks = models.BinaryField()
+    updated_date_time = models.DateTimeField(auto_now=True)
+
+
+class RecognitionJob(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    song = models.OneToOneField(Song, on_delete=models.CASCADE, related_name="recognition_job")
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=QUEUED)
+    task_id = models.CharField(max_length=255, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True)
+    # Percent of the song recognized so far, unknown until its duration is extracted
+    progress = models.PositiveSmallIntegerField(null=True)
+    created_date_time = models.DateTimeField(auto_now_add=True)
+    updated_date_time = models.DateTimeField(auto_now=True)
+
+    def is_expired(self):
+        # Running jobs refresh updated_date_time after every chunk, so only lost or stuck jobs outlive the broker's
+        # visibility timeout
+        timeout = timedelta(seconds=settings.BROKER_TRANSPORT_OPTIONS["visibility_timeout"])
+        return self.status in (self.QUEUED, self.RUNNING) and self.updated_date_time < timezone.now() - timeout
+
+
+class RecognitionChunk(models.Model):
+    job = models.ForeignKey(RecognitionJob, on_delete=models.CASCADE, related_name="chunks")
+    index = models.PositiveIntegerField()
+    text = models.TextField(null=True)
+    end_time = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ["index"]
+        constraints = [models.UniqueConstraint(fields=["job", "index"], name="recognition_chunk_index_unique")]
+
+
+class OutboxEmail(models.Model):
+    WELCOME = "welcome"
+    KIND_CHOICES = [(WELCOME, "Welcome")]
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    to = models.EmailField()
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True)
+    next_attempt_date_time = models.DateTimeField(default=timezone.now)
+    sent_date_time = models.DateTimeField(null=True)
+    created_date_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_date_time"], name="outbox_email_due_idx")]
+
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(ApplicationUser, on_delete=models.CASCADE)
+    key = models.CharField(max_length=100)
+    upload_id = models.CharField(max_length=1024, null=True)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    parts = models.JSONField(default=list)
+    is_completed = models.BooleanField(default=False)
+    created_date_time = models.DateTimeField(auto_now_add=True)
+    updated_date_time = models.DateTimeField(auto_now=True)
+
+
+class SongSimilarity(models.Model):
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="similarities")
+    similar_song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=["song", "-score"], name="song_similarity_score_idx")]
 
 
 class DatabaseAudit(models.Model):
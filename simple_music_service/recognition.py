@@ -0,0 +1,387 @@
+import json
+import math
+import subprocess
+import threading
+import time
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+from pydub import AudioSegment
+from speech_recognition import Recognizer, AudioData, UnknownValueError, RequestError
+from .streaming import read_range
+
+logger = logging.getLogger("django")
+
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+# 10 ms of silence around each chunk, as the recognizer misses words touching the edges
+PADDING = SAMPLE_RATE // 100
+FRAME_SIZE = SAMPLE_RATE // 50
+TARGET_PEAK = 0.9 * np.iinfo(np.int16).max
+MAX_GAIN = 10.0
+# Frames 12 dB above the noise floor, and above -50 dBFS for digitally silent songs, count as speech
+SPEECH_LEVEL_RATIO = 4
+MIN_SPEECH_LEVEL = 100
+# A floor above -38 dBFS is a backing track rather than noise, and vocals over it are rarely 12 dB louder, so every
+# audible frame counts as speech there and the music is cut into full chunks
+MUSIC_BED_LEVEL = 400
+# The noise floor follows the last 30 s of frames, so neither a loud intro nor a silent lead-in sets it for the song
+NOISE_FLOOR_FRAMES = 30 * SAMPLE_RATE // FRAME_SIZE
+# In 20 ms frames: silence kept around speech, shortest pause to cut at, pause that ends a chunk, shortest speech
+HANGOVER_FRAMES = 10
+MIN_CUT_FRAMES = 5
+PAUSE_FRAMES = 50
+MIN_SPEECH_FRAMES = 5
+# Text of a chunk whose recognition kept failing, unlike None for a chunk without recognizable speech
+FAILED = object()
+
+
+def get_recognizer():
+    recognizer = Recognizer()
+    # Bounds every recognizer request, so a stalled connection fails the attempt instead of the whole song
+    recognizer.operation_timeout = settings.SPEECH_RECOGNITION_TIMEOUT
+    return recognizer
+
+
+def recognize_song(song, *, chunk_size=6000):
+    """Yields the text of every speech chunk of the song in order, with the chunk's end time in milliseconds."""
+    end_times = deque()
+
+    def get_audio():
+        for audio, end_time in get_audio_chunks(song, chunk_size=chunk_size):
+            end_times.append(end_time)
+            yield audio
+
+    # Engines consume a chunk before yielding its text, so its end time is always queued by then
+    for text in get_recognition_engine().recognize(get_audio()):
+        yield text, end_times.popleft()
+
+
+def get_audio_chunks(song, *, chunk_size=6000):
+    """Yields AudioData for the speech of the song with its end time, decoded, chunked and normalized as a stream."""
+    noise_floor = NoiseFloorTracker()
+    for samples, end in split_speech(decode_song(song), chunk_size, noise_floor):
+        yield get_audio_data(normalize_samples(samples, noise_floor.level)), end * 1000 // SAMPLE_RATE
+
+
+def split_file_to_chunks(sound, *, chunk_size=6000, noise_floor=None):
+    """Yields the speech in sound as chunks of at most chunk_size milliseconds, skipping silent parts.
+
+    Speech regions are merged until a chunk is full, which is then cut in the latest pause so words are rarely split.
+    sound is an AudioSegment, or an iterable of 16 kHz mono int16 blocks such as decode_song yields, in which case
+    the chunks are sample arrays too. Without a fixed noise_floor, it follows the level of the sound.
+    """
+    if not isinstance(sound, AudioSegment):
+        for samples, _ in split_speech(sound, chunk_size, noise_floor):
+            yield samples
+        return
+
+    segment = sound.set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(SAMPLE_WIDTH)
+    for samples, _ in split_speech([np.frombuffer(segment.raw_data, dtype="<i2")], chunk_size, noise_floor):
+        yield AudioSegment(data=samples.tobytes(), sample_width=SAMPLE_WIDTH, frame_rate=SAMPLE_RATE, channels=1)
+
+
+def split_speech(blocks, chunk_size, noise_floor=None):
+    """Yields speech chunks with the sample position where each ends."""
+    max_frames = max(SAMPLE_RATE * chunk_size // 1000 // FRAME_SIZE, 1)
+    frames = []
+    speech_flags = []
+    pre_roll = deque(maxlen=HANGOVER_FRAMES)
+    silent_run = 0
+    last_pause = None
+    position = 0
+
+    def get_chunk(end):
+        if sum(speech_flags[:end]) >= MIN_SPEECH_FRAMES:
+            return np.concatenate(frames[:end]), position - sum(len(frame) for frame in frames[end:])
+        return None
+
+    for frame, is_speech in get_speech_frames(blocks, noise_floor):
+        position += len(frame)
+        if not frames:
+            if not is_speech:
+                pre_roll.append(frame)
+                continue
+            frames.extend(pre_roll)
+            speech_flags.extend([False] * len(pre_roll))
+            pre_roll.clear()
+        frames.append(frame)
+        speech_flags.append(is_speech)
+
+        if is_speech:
+            if silent_run >= MIN_CUT_FRAMES:
+                last_pause = len(frames) - 1 - silent_run + silent_run // 2
+            silent_run = 0
+        else:
+            silent_run += 1
+
+        if silent_run == PAUSE_FRAMES:
+            chunk = get_chunk(len(frames) - silent_run + HANGOVER_FRAMES)
+            if chunk is not None:
+                yield chunk
+            frames, speech_flags, silent_run, last_pause = [], [], 0, None
+        elif len(frames) >= max_frames:
+            end = last_pause or len(frames)
+            chunk = get_chunk(end)
+            if chunk is not None:
+                yield chunk
+            frames, speech_flags, last_pause = frames[end:], speech_flags[end:], None
+            if not frames:
+                silent_run = 0
+
+    if frames:
+        chunk = get_chunk(len(frames) - max(silent_run - HANGOVER_FRAMES, 0))
+        if chunk is not None:
+            yield chunk
+
+
+def get_speech_frames(blocks, noise_floor=None):
+    """Yields every 20 ms frame of the blocks with whether it is loud enough to be speech.
+
+    noise_floor is a NoiseFloorTracker, a fixed level, or None to track it here.
+    """
+    if not isinstance(noise_floor, NoiseFloorTracker):
+        noise_floor = NoiseFloorTracker(noise_floor)
+    remainder = np.empty(0, dtype="<i2")
+    for block in blocks:
+        samples = np.concatenate([remainder, block])
+        length = len(samples) // FRAME_SIZE * FRAME_SIZE
+        remainder = samples[length:]
+        frames = samples[:length].reshape(-1, FRAME_SIZE)
+        levels = get_frame_levels(samples[:length])
+        # Frames of a block are judged with the floor that already includes them, so a quieter passage is heard
+        # from its first block on
+        noise_floor.update(levels)
+        yield from zip(frames, levels > get_speech_threshold(noise_floor.level))
+    if len(remainder):
+        yield remainder, False
+
+
+class NoiseFloorTracker:
+    """Estimates the noise floor as the level of the quietest tenth of the last NOISE_FLOOR_FRAMES frames.
+
+    Only those levels are kept, so memory use does not depend on the track length. A given level stays fixed.
+    """
+
+    def __init__(self, level=None):
+        self.is_fixed = level is not None
+        self.level = level if self.is_fixed else 0.0
+        self.levels = deque(maxlen=NOISE_FLOOR_FRAMES)
+
+    def update(self, levels):
+        if self.is_fixed or not len(levels):
+            return
+        self.levels.extend(levels.tolist())
+        self.level = float(np.percentile(self.levels, 10))
+
+
+def decode_song(song, *, chunk_size=6000):
+    """Yields int16 arrays of chunk_size milliseconds of 16 kHz mono samples, decoded through an ffmpeg pipe.
+
+    The file is streamed from the storage into ffmpeg while chunks are read back, so memory use does not depend on
+    the track length. ffmpeg also downmixes and resamples, which is cheaper than doing it on the decoded samples.
+    """
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-loglevel", "error", "-i", "pipe:0",
+         "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    errors = []
+    feeder = threading.Thread(target=feed_song, args=(song, process.stdin, errors), daemon=True)
+    feeder.start()
+    chunk_length = SAMPLE_RATE * chunk_size // 1000 * SAMPLE_WIDTH
+    is_finished = False
+    try:
+        while data := process.stdout.read(chunk_length):
+            yield np.frombuffer(data, dtype="<i2")
+        is_finished = True
+    finally:
+        if not is_finished:
+            process.kill()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+        feeder.join()
+    if errors:
+        raise errors[0]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+
+
+def feed_song(song, stdin, errors):
+    storage = song.location.storage
+    name = song.location.name
+    try:
+        for block in read_range(storage, name, 0, storage.size(name) - 1):
+            stdin.write(block)
+    except BrokenPipeError:
+        # ffmpeg stopped reading, its exit status tells why
+        pass
+    except Exception as error:
+        errors.append(error)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def get_frame_levels(samples):
+    """Returns the RMS level of every 20 ms frame."""
+    frames = samples[:len(samples) // FRAME_SIZE * FRAME_SIZE].reshape(-1, FRAME_SIZE).astype(np.float32)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+
+def get_speech_threshold(noise_floor):
+    if noise_floor >= MUSIC_BED_LEVEL:
+        return MIN_SPEECH_LEVEL
+    return max(SPEECH_LEVEL_RATIO * noise_floor, MIN_SPEECH_LEVEL)
+
+
+def normalize_samples(samples, noise_floor):
+    # Amplifying a chunk without speech above the noise would only make the recognizer guess
+    if get_frame_levels(samples).max(initial=0) <= get_speech_threshold(noise_floor):
+        return samples
+    peak = int(np.abs(samples).max())
+    gain = min(TARGET_PEAK / peak, MAX_GAIN)
+    return np.clip(samples * np.float32(gain), -32768, 32767).astype(np.int16)
+
+
+def get_audio_data(samples):
+    padded_samples = np.zeros(len(samples) + 2 * PADDING, dtype="<i2")
+    padded_samples[PADDING:PADDING + len(samples)] = samples
+    return AudioData(padded_samples.tobytes(), SAMPLE_RATE, SAMPLE_WIDTH)
+
+
+def recognize_chunks(recognizer, audio_chunks, *, workers=None):
+    """Recognizes chunks on a thread pool and yields the texts in chunk order, None for chunks without one and FAILED
+    for chunks whose requests kept failing.
+
+    At most two chunks per worker wait for recognition, so chunks are prepared only as fast as they are recognized.
+    """
+    workers = workers or settings.SPEECH_RECOGNITION_WORKERS
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speech-recognition") as executor:
+        pending = deque()
+        for index, audio in enumerate(audio_chunks):
+            pending.append(executor.submit(recognize_chunk, recognizer, audio, index))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def recognize_chunk(recognizer, audio, index):
+    retries = settings.SPEECH_RECOGNITION_RETRIES
+    for attempt in range(retries + 1):
+        try:
+            return recognizer.recognize_google(audio)
+        except UnknownValueError:
+            logger.info(f"Unable to understand sound in chunk {index}")
+            return None
+        # Timeouts are socket.timeout, which only became an alias of TimeoutError in Python 3.10, so every OSError
+        # counts as a failed request
+        except (RequestError, OSError) as error:
+            if attempt == retries:
+                logger.info(f"Unable to request result for chunk {index} after {attempt + 1} attempts: {error}")
+                return FAILED
+            time.sleep(settings.SPEECH_RECOGNITION_RETRY_DELAY * 2 ** attempt)
+
+
+class RecognitionEngine(ABC):
+    """Recognizes AudioData chunks; engines load their models once when created."""
+
+    @abstractmethod
+    def recognize(self, audio_chunks):
+        """Yields the text of every chunk in chunk order, None for chunks without one and FAILED for chunks whose
+        recognition failed."""
+
+
+class BatchRecognitionEngine(RecognitionEngine):
+    """Recognizes chunks in batches of batch_size."""
+
+    batch_size = 1
+
+    def recognize(self, audio_chunks):
+        batch = []
+        for audio in audio_chunks:
+            batch.append(audio)
+            if len(batch) == self.batch_size:
+                yield from self.recognize_batch(batch)
+                batch = []
+        if batch:
+            yield from self.recognize_batch(batch)
+
+    @abstractmethod
+    def recognize_batch(self, batch):
+        """Returns the texts of a list of chunks."""
+
+
+class GoogleRecognitionEngine(RecognitionEngine):
+    def __init__(self):
+        self.recognizer = get_recognizer()
+
+    def recognize(self, audio_chunks):
+        # Requests are network bound, so they run concurrently instead of in batches
+        return recognize_chunks(self.recognizer, audio_chunks)
+
+
+class SphinxRecognitionEngine(BatchRecognitionEngine):
+    def __init__(self):
+        # Fails on start instead of on the first song when pocketsphinx is not installed
+        import pocketsphinx  # noqa: F401
+        self.recognizer = get_recognizer()
+
+    def recognize_batch(self, batch):
+        texts = []
+        for audio in batch:
+            try:
+                texts.append(self.recognizer.recognize_sphinx(audio))
+            except UnknownValueError:
+                texts.append(None)
+        return texts
+
+
+class VoskRecognitionEngine(BatchRecognitionEngine):
+    def __init__(self):
+        from vosk import Model, KaldiRecognizer
+        self.recognizer_class = KaldiRecognizer
+        self.model = Model(settings.VOSK_MODEL_PATH)
+        self.batch_size = settings.SPEECH_RECOGNITION_BATCH_SIZE
+
+    def recognize_batch(self, batch):
+        # One recognizer decodes the whole batch, resetting between chunks instead of being created for each
+        recognizer = self.recognizer_class(self.model, SAMPLE_RATE)
+        texts = []
+        for audio in batch:
+            recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=SAMPLE_WIDTH))
+            texts.append(json.loads(recognizer.FinalResult()).get("text") or None)
+            recognizer.Reset()
+        return texts
+
+
+class FakeRecognitionEngine(BatchRecognitionEngine):
+    """Returns one "word" per started second of a chunk, for tests and local development."""
+
+    batch_size = 8
+
+    def recognize_batch(self, batch):
+        texts = []
+        for audio in batch:
+            seconds = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+            texts.append(" ".join(["word"] * math.ceil(seconds)) or None)
+        return texts
+
+
+_engines = {}
+
+
+def get_recognition_engine():
+    engine_path = settings.SPEECH_RECOGNITION_ENGINE
+    if engine_path not in _engines:
+        _engines[engine_path] = import_string(engine_path)()
+    return _engines[engine_path]
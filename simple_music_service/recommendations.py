@@ -0,0 +1,70 @@
+from itertools import chain
+import logging
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from .models import Rating, SongSimilarity
+
+logger = logging.getLogger("django")
+
+
+def compute_song_similarities(*, neighbours=None, block_size=None):
+    neighbours = neighbours or settings.RECOMMENDATION_NEIGHBOURS
+    block_size = block_size or settings.RECOMMENDATION_BLOCK_SIZE
+
+    song_ids, matrix = load_rating_matrix()
+    similarities_count = 0
+    with transaction.atomic():
+        SongSimilarity.objects.all().delete()
+        # Only block_size rows of the item-item product exist at a time, so memory does not grow with the catalog
+        for start in range(0, matrix.shape[0], block_size):
+            block = (matrix[start:start + block_size] @ matrix.T).tocsr()
+            block.setdiag(0, k=start)
+            block.eliminate_zeros()
+            similarities = list(get_top_similarities(block, song_ids, start, neighbours))
+            SongSimilarity.objects.bulk_create(similarities, batch_size=1000)
+            similarities_count += len(similarities)
+    logger.info(f"Computed {similarities_count} song similarities for {len(song_ids)} songs")
+    return similarities_count
+
+
+def load_rating_matrix():
+    ratings = Rating.objects.order_by().values_list("song", "user", "mark").iterator(chunk_size=10000)
+    ratings = np.fromiter(chain.from_iterable(ratings), dtype=np.int64).reshape(-1, 3)
+    song_ids, song_indexes = np.unique(ratings[:, 0], return_inverse=True)
+    user_ids, user_indexes = np.unique(ratings[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix((ratings[:, 2].astype(np.float32), (song_indexes, user_indexes)),
+                               shape=(len(song_ids), len(user_ids)))
+    # Rows are scaled to unit length, so a row product is the cosine similarity of two songs
+    norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+    return song_ids, sparse.diags(1 / norms, format="csr") @ matrix
+
+
+def get_top_similarities(block, song_ids, start, neighbours):
+    for row in range(block.shape[0]):
+        row_start, row_end = block.indptr[row], block.indptr[row + 1]
+        scores = block.data[row_start:row_end]
+        columns = block.indices[row_start:row_end]
+        if len(scores) > neighbours:
+            top = np.argpartition(-scores, neighbours - 1)[:neighbours]
+            scores, columns = scores[top], columns[top]
+        song_id = int(song_ids[start + row])
+        for column, score in zip(columns, scores):
+            yield SongSimilarity(song_id=song_id, similar_song_id=int(song_ids[column]), score=float(score))
+
+
+def get_similar_songs(song_id, count):
+    similarities = SongSimilarity.objects.filter(song=song_id).order_by("-score")[:count]
+    return list(similarities.values_list("similar_song", "score"))
+
+
+def get_recommended_songs(user_id, count):
+    # Neighbours of the user's rated songs, weighted by the user's marks, minus songs the user already rated
+    recommendations = SongSimilarity.objects.filter(song__rating__user=user_id) \
+        .exclude(similar_song__rating__user=user_id) \
+        .values("similar_song") \
+        .annotate(recommendation_score=Sum(F("score") * F("song__rating__mark"))) \
+        .order_by("-recommendation_score")[:count]
+    return list(recommendations.values_list("similar_song", "recommendation_score"))
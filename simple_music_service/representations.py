@@ -0,0 +1,84 @@
+from simple_music_service import serializers
+from .models import Song, Artist, Rating, SongRendition
+
+SONG_COLUMNS = {
+    "id": "id",
+    "title": "title",
+    "year": "year",
+    "location": "location",
+    "average_rating": "avg_rating",
+    "reviews_count": "rating_count",
+    "comments_count": "comment_count",
+    "lyrics": "lyrics",
+    "duration": "duration",
+    "bitrate": "bitrate",
+    "sample_rate": "sample_rate",
+    "channels": "channels",
+    "size": "size",
+}
+
+
+def get_song_representation_fields(fields):
+    declared_fields = serializers.SongSerializer._declared_fields
+    return [field for field in fields if not getattr(declared_fields.get(field), "write_only", False)]
+
+
+def get_song_rows(queryset, fields):
+    columns = {"id"} | {SONG_COLUMNS[field] for field in fields if field in SONG_COLUMNS}
+    return queryset.prefetch_related(None).values(*columns)
+
+
+def get_song_representations(rows, fields, request):
+    rows = list(rows)
+    song_ids = [row["id"] for row in rows]
+    artists = get_song_artists(song_ids) if "artist" in fields else {}
+    user_marks = get_user_marks(song_ids, request.user) if "user_mark" in fields else {}
+    renditions = get_song_renditions(song_ids, request) if "renditions" in fields else {}
+    average_rating_field = serializers.SongSerializer._declared_fields["average_rating"]
+    storage = Song._meta.get_field("location").storage
+
+    def get_location(row):
+        return request.build_absolute_uri(storage.url(row["location"])) if row["location"] else None
+
+    def get_average_rating(row):
+        average_rating = row["avg_rating"]
+        return average_rating_field.to_representation(average_rating) if average_rating is not None else None
+
+    field_getters = {
+        "year": lambda row: row["year"].isoformat(),
+        "artist": lambda row: artists.get(row["id"], []),
+        "location": get_location,
+        "renditions": lambda row: renditions.get(row["id"], []),
+        "average_rating": get_average_rating,
+        "user_mark": lambda row: user_marks.get(row["id"]),
+    }
+    getters = [(field, field_getters.get(field, lambda row, column=SONG_COLUMNS.get(field): row[column]))
+               for field in fields]
+    return [{field: getter(row) for field, getter in getters} for row in rows]
+
+
+def get_song_artists(song_ids):
+    artists = {}
+    for song_id, artist_id, artist_name in Artist.objects.filter(song__in=song_ids).values_list("song", "id", "name"):
+        artists.setdefault(song_id, []).append({"id": artist_id, "name": artist_name})
+    return artists
+
+
+def get_song_renditions(song_ids, request):
+    storage = SongRendition._meta.get_field("location").storage
+    renditions = {}
+    for song_id, rendition_format, bitrate, location in SongRendition.objects.filter(song__in=song_ids) \
+            .values_list("song", "format", "bitrate", "location"):
+        renditions.setdefault(song_id, []).append({
+            "format": rendition_format,
+            "bitrate": bitrate,
+            "location": request.build_absolute_uri(storage.url(location)),
+        })
+    return renditions
+
+
+def get_user_marks(song_ids, user):
+    if not user.is_authenticated:
+        return {}
+    ratings = Rating.objects.filter(song__in=song_ids, user=user.id).values("id", "mark", "song")
+    return {rating["song"]: {"id": rating["id"], "mark": rating["mark"]} for rating in ratings}
@@ -1,10 +1,15 @@
 from backend import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from .models import Song, Artist, Playlist, Rating, Comment, ApplicationUser
+from .models import (Song, Artist, Playlist, Rating, Comment, ApplicationUser, DatabaseAuditMixin, UploadSession,
+                     SongRendition, schedule_song_processing)
+from .caches import invalidate_song_cache, invalidate_artist_cache
+from .uploads import verify_uploaded_song, get_upload_key, get_upload_backend, store_song_audio
 from .exceptions import AlreadyExistingObjectException
-from .mixins import UserMarkMixin
-from .tasks import send_welcome_email
+from .mixins import UserMarkMixin, SparseFieldsetMixin
+from .tasks import queue_welcome_email
 
 
 class ArtistSerializer(serializers.ModelSerializer):
@@ -31,8 +36,40 @@ class RatingSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
-class SongSerializer(serializers.ModelSerializer, UserMarkMixin):
+class SongRenditionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SongRendition
+        fields = ["format", "bitrate", "location"]
+
+
+class SongListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        user_id = self.context["request"].user.id
+        with transaction.atomic():
+            artists = get_or_create_artists({name for song_data in validated_data for name in song_data["artist_list"]})
+            audio = store_song_audio([song_data["location"] for song_data in validated_data])
+            for song_data, song_audio in zip(validated_data, audio):
+                set_song_audio(song_data, song_audio)
+            songs = Song.objects.bulk_create([
+                Song(user_id=user_id, **{field: value for field, value in song_data.items() if field != "artist_list"})
+                for song_data in validated_data
+            ])
+            through_model = Song.artist.through
+            through_instances = through_model.objects.bulk_create([
+                through_model(song_id=song.id, artist_id=artists[artist_name])
+                for song, song_data in zip(songs, validated_data)
+                for artist_name in dict.fromkeys(song_data["artist_list"])
+            ])
+            DatabaseAuditMixin.bulk_save_created_audit_data([*songs, *through_instances])
+            invalidate_song_cache(*(song.id for song in songs))
+            for song in songs:
+                schedule_song_processing(song.id)
+        return songs
+
+
+class SongSerializer(SparseFieldsetMixin, serializers.ModelSerializer, UserMarkMixin):
     artist = ArtistSerializer(many=True, read_only=True)
+    renditions = SongRenditionSerializer(many=True, read_only=True)
     artist_list = serializers.ListSerializer(
         child=serializers.CharField(max_length=50), write_only=True
     )
@@ -42,26 +79,69 @@ class SongSerializer(serializers.ModelSerializer, UserMarkMixin):
 
     class Meta:
         model = Song
-        fields = ["id", "title", "year", "artist", "artist_list", "location", "average_rating", "reviews_count",
-                  "user_mark", "comments_count", "lyrics"]
+        fields = ["id", "title", "year", "artist", "artist_list", "location", "renditions", "average_rating",
+                  "reviews_count", "user_mark", "comments_count", "lyrics", "duration", "bitrate", "sample_rate",
+                  "channels", "size"]
+        read_only_fields = ["duration", "bitrate", "sample_rate", "channels", "size"]
+        list_serializer_class = SongListSerializer
 
     @staticmethod
     def get_comments_count(obj):
-        return Song.objects.get(id=obj.id).comment_set.count()
+        if hasattr(obj, "comment_count"):
+            return obj.comment_count
+        return obj.comment_set.count()
+
+    def create(self, validated_data):
+        return create_song(self.context["request"].user.id, validated_data)
+
+
+class SongUploadSerializer(SongSerializer):
+    location = serializers.CharField(max_length=100)
+
+    def validate_location(self, key):
+        try:
+            verify_uploaded_song(key, self.context["request"].user.id)
+        except DjangoValidationError as error:
+            raise serializers.ValidationError(error.messages)
+        return key
+
+    def to_representation(self, instance):
+        return SongSerializer(instance, context=self.context).data
+
+
+class BulkSongSerializer(serializers.Serializer):
+    songs = SongSerializer(many=True, allow_empty=False)
+
+    @staticmethod
+    def validate_songs(songs):
+        if len(songs) > settings.BULK_UPLOAD_MAX_SONGS:
+            raise serializers.ValidationError(f"Ensure this field has no more than {settings.BULK_UPLOAD_MAX_SONGS} "
+                                              f"elements.")
+        return songs
+
+    def create(self, validated_data):
+        return {"songs": self.fields["songs"].create(validated_data["songs"])}
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ["id", "size", "offset", "is_completed"]
+        read_only_fields = ["offset", "is_completed"]
+
+    @staticmethod
+    def validate_size(size):
+        if not 0 < size <= settings.SONG_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"Ensure the file size is between 1 and {settings.SONG_UPLOAD_MAX_SIZE} "
+                                              f"bytes.")
+        return size
 
     def create(self, validated_data):
         user_id = self.context["request"].user.id
-        validated_data["user_id"] = user_id
-        artist_list = validated_data.pop("artist_list")
-        song = Song.objects.create(**validated_data)
-        for artist_name in artist_list:
-            try:
-                artist = Artist.objects.get(name=artist_name)
-            except Artist.DoesNotExist:
-                artist = Artist.objects.create(name=artist_name)
-            song.artist.add(artist)
-        song.save()
-        return song
+        session = UploadSession(user_id=user_id, key=get_upload_key(user_id), **validated_data)
+        session.upload_id = get_upload_backend().start(session)
+        session.save()
+        return session
 
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -88,8 +168,10 @@ class UserSerializer(serializers.ModelSerializer):
     def create(self, *args, **kwargs):
         user_data = args[0]
         user = ApplicationUser(**user_data)
-        self.__save_user(user)
-        send_welcome_email.delay(user.email)
+        with transaction.atomic():
+            self.__save_user(user)
+            if user.email:
+                queue_welcome_email(user.email)
         return user
 
     def update(self, *args, **kwargs):
@@ -120,7 +202,7 @@ class PlaylistSongSerializer(serializers.ModelSerializer, UserMarkMixin):
         }
 
 
-class PlaylistSerializer(serializers.ModelSerializer):
+class PlaylistSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     song = PlaylistSongSerializer(many=True)
 
     class Meta:
@@ -155,7 +237,7 @@ class PlaylistSerializer(serializers.ModelSerializer):
             getattr(instance.song, method)(song)
 
 
-class CommentForSongSerializer(serializers.ModelSerializer):
+class CommentForSongSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     created_date_time = serializers.DateTimeField(format=settings.DATETIME_FORMAT, read_only=True)
 
@@ -168,7 +250,7 @@ class CommentForSongSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class CommentForUserSerializer(serializers.ModelSerializer):
+class CommentForUserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     song = SongSerializer(read_only=True)
     created_date_time = serializers.DateTimeField(format=settings.DATETIME_FORMAT, read_only=True)
 
@@ -182,3 +264,52 @@ def set_song_and_user_data(instance, validated_data):
     validated_data["user_id"] = user_id
     song_id = instance.context["request"].parser_context["kwargs"]["songs_pk"]
     validated_data["song_id"] = song_id
+
+
+def create_song(user_id, validated_data):
+    validated_data["user_id"] = user_id
+    artist_list = validated_data.pop("artist_list")
+    with transaction.atomic():
+        if isinstance(validated_data["location"], str):
+            # Direct uploads are moved to their AudioBlob by process_song, so the upload is not read here
+            validated_data["upload_key"] = validated_data["location"]
+        else:
+            set_song_audio(validated_data, store_song_audio([validated_data["location"]])[0])
+        try:
+            with transaction.atomic():
+                song = Song.objects.create(**validated_data)
+        except IntegrityError:
+            if "upload_key" not in validated_data:
+                raise
+            # Another request finalized the same upload since it was validated
+            raise serializers.ValidationError({"location": ["This upload has already been finalized."]})
+        for artist_name in artist_list:
+            try:
+                artist = Artist.objects.get(name=artist_name)
+            except Artist.DoesNotExist:
+                artist = Artist.objects.create(name=artist_name)
+            song.artist.add(artist)
+        song.save()
+    return song
+
+
+def set_song_audio(song_data, audio):
+    song_data["audio"] = audio
+    song_data["location"] = audio.location.name
+    if audio.lyrics is not None:
+        # Identical audio was already transcribed for another song
+        song_data.setdefault("lyrics", audio.lyrics)
+
+
+def get_or_create_artists(artist_names):
+    artists = dict(Artist.objects.filter(name__in=artist_names).values_list("name", "id"))
+    new_artist_names = set(artist_names) - set(artists)
+    if new_artist_names:
+        # Conflicts with artists created concurrently are ignored, so ids are read back instead of returned
+        Artist.objects.bulk_create([Artist(name=artist_name) for artist_name in new_artist_names],
+                                   ignore_conflicts=True)
+        new_artists = list(Artist.objects.filter(name__in=new_artist_names))
+        DatabaseAuditMixin.bulk_save_created_audit_data(new_artists)
+        invalidate_artist_cache()
+        artists.update((artist.name, artist.id) for artist in new_artists)
+    return artists
@@ -0,0 +1,89 @@
+import re
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from rest_framework import status
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def get_song_stream_response(request, song):
+    storage = song.location.storage
+    name = song.location.name
+    if settings.SONG_STREAM_MODE == "redirect":
+        return HttpResponseRedirect(storage.url(name, expire=settings.SONG_STREAM_URL_EXPIRES))
+    if settings.SONG_STREAM_MODE == "accel":
+        return get_accel_response(storage.url(name, expire=settings.SONG_STREAM_URL_EXPIRES))
+    return get_range_response(request, storage, name)
+
+
+def get_accel_response(signed_url):
+    # nginx fetches the signed URL itself, forwarding the client's Range header, so no worker stays busy
+    response = HttpResponse(content_type="audio/mpeg")
+    response["X-Accel-Redirect"] = f"{settings.SONG_STREAM_ACCEL_PREFIX}{signed_url.split('://', 1)[1]}"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def get_range_response(request, storage, name):
+    size = storage.size(name)
+    byte_range = parse_range(request.headers.get("Range"), size)
+    if byte_range is False:
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(read_range(storage, name, start, end), content_type="audio/mpeg")
+    if byte_range:
+        response.status_code = status.HTTP_206_PARTIAL_CONTENT
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Content-Length"] = end - start + 1
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def parse_range(range_header, size):
+    """Returns (start, end) for a single satisfiable range, None to send the whole file and False for a 416."""
+    if not range_header:
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        # Multiple or malformed ranges may be ignored in favour of a full response
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        suffix_length = int(end)
+        if suffix_length == 0:
+            return False
+        return max(size - suffix_length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_range(storage, name, start, end):
+    if hasattr(storage, "bucket"):
+        # S3 serves the range itself instead of the storage file downloading the whole object first
+        body = storage.bucket.Object(name).get(Range=f"bytes={start}-{end}")["Body"]
+        yield from body.iter_chunks(STREAM_BLOCK_SIZE)
+        return
+
+    with storage.open(name) as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = file.read(min(remaining, STREAM_BLOCK_SIZE))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def is_new_play(request):
+    byte_range = request.headers.get("Range", "")
+    return not byte_range or byte_range.startswith("bytes=0-")
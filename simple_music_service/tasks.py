@@ -1,71 +1,200 @@
-from anymail.message import AnymailMessage
 from backend.celery import app
-from pydub import AudioSegment
-from speech_recognition import Recognizer, AudioFile, UnknownValueError, RequestError
-from io import BytesIO
-import requests
+from celery.signals import worker_process_init
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 import logging
-from .models import Song
+from .models import Song, AudioBlob, RecognitionJob, RecognitionChunk, OutboxEmail
+from . import emails, leaderboards, metadata, recognition, recommendations, transcoding, uploads, waveforms
 
 logger = logging.getLogger("django")
 
 
+@worker_process_init.connect
+def preload_recognition_engine(**kwargs):
+    # Models are loaded once per worker process and kept warm across tasks. Other workers load them on the first
+    # recognition task, if any, so a missing engine package only fails that task.
+    if settings.SPEECH_RECOGNITION_PRELOAD:
+        recognition.get_recognition_engine()
+
+
+@app.task
+def send_outbox_emails():
+    emails.send_outbox_emails()
+
+
+def queue_welcome_email(user_email):
+    OutboxEmail.objects.create(kind=OutboxEmail.WELCOME, to=user_email)
+    transaction.on_commit(schedule_outbox_emails)
+
+
+def schedule_outbox_emails():
+    # Emails queued within the delay share one sending task; the periodic run picks up retries
+    if cache.add("outbox-emails-scheduled", True, timeout=settings.EMAIL_OUTBOX_DELAY):
+        send_outbox_emails.apply_async(countdown=settings.EMAIL_OUTBOX_DELAY)
+
+
+@app.task
+def process_song(song_id):
+    try:
+        uploads.deduplicate_uploaded_song(song_id)
+    except (BotoCoreError, ClientError, OSError) as error:
+        # The song keeps its upload, which is processed all the same
+        logger.warning(f"Unable to deduplicate the audio of song {song_id}: {error}")
+    extract_song_metadata.delay(song_id)
+    transcode_song.delay(song_id)
+    compute_song_waveform.delay(song_id)
+
+
+@app.task
+def delete_stale_upload_sessions():
+    deleted = uploads.delete_stale_upload_sessions()
+    logger.info(f"Deleted {deleted} stale upload sessions")
+
+
+@app.task
+def extract_song_metadata(song_id):
+    metadata.extract_song_metadata(song_id)
+
+
+@app.task
+def transcode_song(song_id):
+    transcoding.transcode_song(song_id)
+
+
 @app.task
-def send_welcome_email(user_email):
-    message = AnymailMessage(
-        subject="Welcome to Simple music service",
-        body="Thank you for creating an account on our service.",
-        to=[user_email],
-    )
-    message.send()
-    logger.info(f"Email sent to {user_email}")
+def compute_song_waveform(song_id):
+    waveforms.compute_song_waveform(song_id)
 
 
-@app.task()
+@app.task(ignore_result=True)
+def record_song_play(song_id):
+    # update() skips lifecycle hooks on purpose: play counts are not part of cached song representations
+    Song.objects.filter(id=song_id).update(play_count=F("play_count") + 1)
+
+
+@app.task
+def refresh_leaderboards():
+    leaderboards.refresh_leaderboards()
+    logger.info("Leaderboards refreshed")
+
+
+@app.task
+def compute_song_similarities():
+    recommendations.compute_song_similarities()
+
+
+# Acknowledged once done, so the song of a crashed worker is redelivered instead of lost, and a prefetched message is
+# never acknowledged while it waits. The rate limit applies per worker and spares the recognition API's quota
+@app.task(acks_late=True, soft_time_limit=settings.RECOGNITION_TASK_SOFT_TIME_LIMIT,
+          time_limit=settings.RECOGNITION_TASK_TIME_LIMIT, rate_limit=settings.RECOGNITION_TASK_RATE_LIMIT)
 def recognize_speech_from_file(song_id):
     task_id = recognize_speech_from_file.request.id
     logger.info(f"Started recognize_speech_from_file task: {task_id}")
 
-    recognized_string = []
-    song = Song.objects.get(id=song_id)
+    job = start_recognition_job(song_id, task_id)
+    if job is None:
+        logger.info(f"Recognition of song {song_id} is done or running elsewhere, skipping the task {task_id}")
+        return
+
     try:
-        response = requests.get(song.location.url)
-        if response.status_code == 200:
-            with BytesIO(response.content) as file:
-                sound = AudioSegment.from_mp3(file)
-
-            recognizer = Recognizer()
-
-            chunks = split_file_to_chunks(sound)
-            chunk_silent = AudioSegment.silent(duration=10)
-            for chunk in chunks:
-                audio_chunk = chunk_silent + chunk + chunk_silent
-                with BytesIO() as memory_buffer:
-                    audio_chunk.export(memory_buffer, format="wav")
-                    with AudioFile(memory_buffer) as source:
-                        recognizer.adjust_for_ambient_noise(source)
-                        audio = recognizer.record(source)
-                try:
-                    s = recognizer.recognize_google(audio)
-                    recognized_string.append(s)
-                except UnknownValueError:
-                    logger.info(f"Unable to understand sound in the task {task_id}")
-                except RequestError as error:
-                    logger.info(f"Unable to request result in the task {task_id}: {error}")
-        else:
-            logger.info(f"Response code {response.status_code} for getting file {song.location.url}")
-    except requests.exceptions.RequestException as exception:
-        logger.info(f"Exception occurred in the task {task_id}: {exception}")
+        recognized_string = []
+        song = Song.objects.select_related("audio").get(id=song_id)
+        if song.audio is not None and song.audio.lyrics is not None:
+            song.lyrics = song.audio.lyrics
+            song.save()
+            finish_recognition_job(job, RecognitionJob.DONE)
+            logger.info(f"Reused lyrics of identical audio in the task {task_id}")
+            return
 
-    if len(recognized_string) > 0:
-        song.lyrics = " ".join(recognized_string)
-    else:
-        song.lyrics = ""
-    song.save()
+        # Decoding and storage errors fail the job, which the next request queues again, instead of saving the lyrics
+        # recognized up to that point
+        failed_chunks = 0
+        for index, (text, end_time) in enumerate(recognition.recognize_song(song)):
+            if text is recognition.FAILED:
+                failed_chunks += 1
+                text = None
+            progress = min(end_time * 100 // song.duration, 99) if song.duration else None
+            if not save_recognition_chunk(job, index, text, end_time, progress):
+                logger.info(f"Recognition of song {song_id} was restarted, stopping the task {task_id}")
+                return
+            if text:
+                recognized_string.append(text)
+
+        if len(recognized_string) > 0:
+            song.lyrics = " ".join(recognized_string)
+        else:
+            song.lyrics = ""
+        song.save()
+        if failed_chunks:
+            # Incomplete lyrics stay with this song, identical uploads are recognized again
+            logger.warning(f"Recognition of {failed_chunks} chunks of song {song_id} failed in the task {task_id}")
+        elif song.audio_id is not None:
+            share_lyrics(song.audio_id, song.lyrics)
+        finish_recognition_job(job, RecognitionJob.DONE)
+    except Exception as error:
+        finish_recognition_job(job, RecognitionJob.FAILED, error=str(error))
+        raise
 
     logger.info(f"Ended recognize_speech_from_file task: {task_id}")
 
 
-def split_file_to_chunks(sound, *, chunk_size=6000):
-    for i in range(0, len(sound), chunk_size):
-        yield sound[i:i + chunk_size]
+def request_speech_recognition(song_id):
+    """Returns the song's recognition job, queuing it unless it is already queued or running and not expired."""
+    with transaction.atomic():
+        job, created = RecognitionJob.objects.select_for_update().get_or_create(song_id=song_id)
+        if created or job.status == RecognitionJob.FAILED or job.is_expired():
+            job.status = RecognitionJob.QUEUED
+            job.attempts += 1
+            job.error = None
+            job.save()
+            transaction.on_commit(lambda: recognize_speech_from_file.delay(song_id))
+    return job
+
+
+def start_recognition_job(song_id, task_id):
+    with transaction.atomic():
+        job = RecognitionJob.objects.select_for_update(of=("self",)).select_related("song") \
+            .filter(song_id=song_id).first()
+        if job is None:
+            if not Song.objects.filter(id=song_id).exists():
+                return None
+            job = RecognitionJob(song_id=song_id, attempts=1)
+        elif job.status == RecognitionJob.DONE or (job.status == RecognitionJob.RUNNING and not job.is_expired()):
+            # A duplicate message, or one redelivered while another worker still works on the song
+            return None
+        job.status = RecognitionJob.RUNNING
+        job.task_id = task_id
+        job.progress = 0 if job.song.duration else None
+        job.save()
+        # Partial results of a previous run are replaced by this one
+        job.chunks.all().delete()
+    return job
+
+
+def save_recognition_chunk(job, index, text, end_time, progress):
+    """Saves a partial result and refreshes the job's heartbeat; returns False once another task took the job over."""
+    with transaction.atomic():
+        is_alive = RecognitionJob.objects.filter(id=job.id, status=RecognitionJob.RUNNING, task_id=job.task_id) \
+            .update(progress=progress, updated_date_time=timezone.now()) > 0
+        if is_alive:
+            RecognitionChunk.objects.create(job=job, index=index, text=text, end_time=end_time)
+    return is_alive
+
+
+def finish_recognition_job(job, status, *, error=None):
+    fields = {"status": status, "error": error, "updated_date_time": timezone.now()}
+    if status == RecognitionJob.DONE:
+        fields["progress"] = 100
+    RecognitionJob.objects.filter(id=job.id, task_id=job.task_id).update(**fields)
+
+
+def share_lyrics(audio_id, lyrics):
+    AudioBlob.objects.filter(id=audio_id).update(lyrics=lyrics)
+    for song in Song.objects.filter(audio=audio_id, lyrics__isnull=True):
+        song.lyrics = lyrics
+        song.save(update_fields=["lyrics"])
+
@@ -1,3 +1,4 @@
+from datetime import date, timedelta
 from factory.django import DjangoModelFactory, FileField
 from factory import Sequence, SubFactory, post_generation, PostGenerationMethodCall
 from .models import Artist, Song, Playlist, Rating, Comment, ApplicationUser
@@ -23,7 +24,7 @@ class SongFactory(DjangoModelFactory):
         model = Song
 
     title = Sequence(lambda n: f"song title {n}")
-    year = Sequence(lambda n: f"2020-12-{n + 1:02d}")
+    year = Sequence(lambda n: (date(2020, 12, 1) + timedelta(days=n)).isoformat())
     location = FileField(filename="song.mp3")
     user = SubFactory(UserFactory)
 
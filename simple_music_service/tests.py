@@ -1,14 +1,62 @@
 from rest_framework.test import APITestCase
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core import mail
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+import os
+import socket
+import subprocess
+import tempfile
+import time
+from hashlib import sha256
+from unittest import mock, skipUnless
+from shutil import which
+from io import BytesIO
+from pydub import AudioSegment
+from pydub.generators import Sine
+from speech_recognition import RequestError, UnknownValueError
+from redis.exceptions import RedisError
 from moto import mock_s3
+from anymail.exceptions import AnymailAPIError
+from cryptography.fernet import Fernet
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
 import boto3
+import numpy as np
+import requests
 from .serializers import (ArtistSerializer, SongSerializer, PlaylistSerializer, CommentForSongSerializer,
                           CommentForUserSerializer)
 from .test_factories import ArtistFactory, UserFactory, SongFactory, PlaylistFactory, RatingFactory, CommentFactory
-from .models import Artist, Playlist, Rating, Comment, Song, ApplicationUser, DatabaseAudit
+from .models import (Artist, Playlist, Rating, Comment, Song, ApplicationUser, DatabaseAudit, SongSimilarity,
+                     SongRendition, AudioBlob, RecognitionJob, RecognitionChunk, OutboxEmail, UploadSession)
+from .transcoding import transcode_song
+from .waveforms import compute_song_waveform
+from .metadata import extract_song_metadata
+from .uploads import deduplicate_uploaded_song, delete_stale_upload_sessions, LocalUploadBackend
+from .emails import send_outbox_emails
+from .feature_flags import get_feature_flag_value
+from .uploads import get_audio_key
+from .tasks import recognize_speech_from_file, preload_recognition_engine
+from .recognition import (recognize_chunks, decode_song, split_file_to_chunks, split_speech, BatchRecognitionEngine,
+                          NoiseFloorTracker, get_frame_levels, normalize_samples, get_audio_data,
+                          get_recognition_engine, FAILED, SAMPLE_RATE, SAMPLE_WIDTH, PADDING)
+from .leaderboards import LocalSortedSetStore
+from backend.asgi import application
+from backend.celery import app as celery_app
+from backend import secrets
+from .recommendations import compute_song_similarities
+
+TEST_FEATURE_FLAG_FILE = os.path.join(os.path.dirname(__file__), "test_feature_flags.json")
 
 
 class ArtistViewSetTest(APITestCase):
@@ -65,6 +113,153 @@ class SignUpViewSetTest(APITestCase):
         self.assertEqual(payload["username"], getattr(created_user, "username"))
 
 
+class OutboxEmailTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    @staticmethod
+    def get_api_error(status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = "Error"
+        return AnymailAPIError("Sending failed", status_code=status_code, response=response)
+
+    def test_sign_up_sends_welcome_email_through_outbox(self):
+        payload = {"username": "testUsername", "password": "test password", "email": "new@example.com"}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("signup-list"), payload)
+
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(["new@example.com"], mail.outbox[0].to)
+        self.assertEqual(OutboxEmail.SENT, OutboxEmail.objects.get(to="new@example.com").status)
+
+    @override_settings(EMAIL_OUTBOX_BATCH_SIZE=2)
+    def test_batches_share_one_connection(self):
+        OutboxEmail.objects.bulk_create(OutboxEmail(kind=OutboxEmail.WELCOME, to=f"user{i}@example.com")
+                                        for i in range(5))
+
+        with mock.patch("simple_music_service.emails.get_connection", wraps=mail.get_connection) as get_connection:
+            sent = send_outbox_emails()
+
+        self.assertEqual(5, sent)
+        self.assertEqual(5, len(mail.outbox))
+        get_connection.assert_called_once()
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.SENT).exists())
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_emails_are_retried_with_backoff(self):
+        email = OutboxEmail.objects.create(kind=OutboxEmail.WELCOME, to="user@example.com")
+        error = self.get_api_error(503)
+
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=error):
+            send_outbox_emails()
+            email.refresh_from_db()
+            self.assertEqual((OutboxEmail.PENDING, 1), (email.status, email.attempts))
+            self.assertGreater(email.next_attempt_date_time, timezone.now() + timedelta(seconds=20))
+
+            # Not due yet
+            send_outbox_emails()
+            self.assertEqual(1, OutboxEmail.objects.get(id=email.id).attempts)
+
+            OutboxEmail.objects.update(next_attempt_date_time=timezone.now())
+            send_outbox_emails()
+        email.refresh_from_db()
+        self.assertEqual((OutboxEmail.FAILED, 2), (email.status, email.attempts))
+
+    def test_throttling_postpones_the_rest_of_the_batch(self):
+        OutboxEmail.objects.bulk_create(OutboxEmail(kind=OutboxEmail.WELCOME, to=f"user{i}@example.com")
+                                        for i in range(3))
+        error = self.get_api_error(429)
+
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=[1, error]):
+            self.assertEqual(1, send_outbox_emails())
+
+        emails = OutboxEmail.objects.order_by("to")
+        self.assertEqual([OutboxEmail.SENT, OutboxEmail.PENDING, OutboxEmail.PENDING], [e.status for e in emails])
+        self.assertEqual([0, 1, 0], [e.attempts for e in emails])
+        self.assertFalse(emails.filter(status=OutboxEmail.PENDING, next_attempt_date_time__lte=timezone.now()).exists())
+
+
+class SecretsTest(APITestCase):
+    def setUp(self):
+        secrets.clear_secrets_cache()
+        self.addCleanup(secrets.clear_secrets_cache)
+
+    def test_secrets_are_fetched_once_per_process(self):
+        with mock.patch("backend.secrets.get_aws_secrets", wraps=secrets.get_aws_secrets) as get_aws_secrets:
+            secrets.get_secret_value("DJANGO_SECRET_KEY")
+            secrets.get_secret_value("SENDINBLUE_API_KEY")
+
+        get_aws_secrets.assert_called_once()
+
+    def test_secrets_are_refreshed_after_ttl(self):
+        with mock.patch.dict(os.environ, {"SECRETS_CACHE_TTL": "60"}), \
+                mock.patch("backend.secrets.get_aws_secrets", return_value={"KEY": "old"}):
+            secrets.get_secret_value("KEY")
+        with mock.patch.dict(os.environ, {"SECRETS_CACHE_TTL": "60"}), \
+                mock.patch("backend.secrets.get_aws_secrets", return_value={"KEY": "new"}), \
+                mock.patch("time.monotonic", return_value=time.monotonic() + 61):
+            self.assertEqual("new", secrets.get_secret_value("KEY"))
+
+    def test_secrets_can_be_read_from_environment_and_file(self):
+        with mock.patch.dict(os.environ, {"SECRETS_PROVIDER": "env", "API_KEY": "from environment"}):
+            self.assertEqual("from environment", secrets.get_secret_value("API_KEY"))
+
+        secrets.clear_secrets_cache()
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+            file.write('{"API_KEY": "from file"}')
+            file.flush()
+            with mock.patch.dict(os.environ, {"SECRETS_PROVIDER": "file", "SECRETS_FILE": file.name}):
+                self.assertEqual("from file", secrets.get_secret_value("API_KEY"))
+
+    def test_encrypted_cache_file_skips_fetching(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "secrets.cache")
+            environment = {"SECRETS_CACHE_FILE": path, "SECRETS_CACHE_KEY": Fernet.generate_key().decode()}
+            with mock.patch.dict(os.environ, environment):
+                with mock.patch("backend.secrets.get_aws_secrets", return_value={"KEY": "secret value"}):
+                    secrets.get_secret_value("KEY")
+                secrets.clear_secrets_cache()
+                with mock.patch("backend.secrets.get_aws_secrets") as get_aws_secrets:
+                    self.assertEqual("secret value", secrets.get_secret_value("KEY"))
+
+            get_aws_secrets.assert_not_called()
+            with open(path, "rb") as file:
+                self.assertNotIn(b"secret value", file.read())
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+
+@override_settings(FEATURE_FLAG_FILE=TEST_FEATURE_FLAG_FILE)
+class FeatureFlagTest(APITestCase):
+    def test_flags_are_read_from_local_file(self):
+        self.assertTrue(get_feature_flag_value("isDeleteSongAvailable"))
+        self.assertFalse(get_feature_flag_value("unknownFlag"))
+
+    def test_flag_values_are_cached(self):
+        get_feature_flag_value("isDeleteSongAvailable")
+
+        with mock.patch("ldclient.client.LDClient.variation") as variation:
+            for _ in range(100):
+                self.assertTrue(get_feature_flag_value("isDeleteSongAvailable"))
+
+        variation.assert_not_called()
+
+    @mock_s3
+    def test_disabled_flag_forbids_deleting_songs(self):
+        boto3.resource("s3", region_name="us-east-1").create_bucket(Bucket="simple-music-service-storage")
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+            file.write('{"flagValues": {"isDeleteSongAvailable": false}}')
+            file.flush()
+            with override_settings(FEATURE_FLAG_FILE=file.name):
+                song = SongFactory.create()
+                authorization(self.client, song.user)
+                response = self.client.delete(reverse("nested-song-detail", args=[song.user_id, song.id]))
+
+        self.assertEqual(status.HTTP_405_METHOD_NOT_ALLOWED, response.status_code)
+        self.assertTrue(Song.objects.filter(id=song.id).exists())
+
+
 class TokenViewSetTest(APITestCase):
     @classmethod
     def setUpTestData(cls):
@@ -149,10 +344,120 @@ class SongViewSetTest(APITestCase):
         response = self.client.post(reverse("nested-song-list", args=[self.user.id]), payload)
 
         self.assertEqual(status.HTTP_201_CREATED, response.status_code)
-        body = s3.Object(self.bucket_name, file_name).get()["Body"].read().decode("utf-8")
+        song = Song.objects.get(id=response.data["id"])
+        self.assertEqual(get_audio_key(sha256(file_body.encode()).hexdigest()), song.location.name)
+        body = s3.Object(self.bucket_name, song.location.name).get()["Body"].read().decode("utf-8")
         self.assertEqual(body, file_body)
 
     @mock_s3
+    def test_identical_uploads_share_stored_audio(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+
+        def upload_song(title):
+            payload = {
+                "title": title,
+                "year": "2020-12-12",
+                "artist_list[0]": "duplicated artist",
+                "location": SimpleUploadedFile(f"{title}.mp3", b"duplicated file body"),
+            }
+            response = self.client.post(reverse("nested-song-list", args=[self.user.id]), payload)
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+            return Song.objects.get(id=response.data["id"])
+
+        first_song = upload_song("first")
+        second_song = upload_song("second")
+
+        self.assertEqual(first_song.audio_id, second_song.audio_id)
+        self.assertEqual(first_song.location.name, second_song.location.name)
+        self.assertEqual(1, AudioBlob.objects.count())
+        self.assertEqual(1, len(list(s3.Bucket(self.bucket_name).objects.filter(Prefix="audio/"))))
+        audio_object = s3.Object(self.bucket_name, first_song.location.name)
+        first_song.delete()
+        audio_object.load()
+        second_song.delete()
+        self.assertFalse(AudioBlob.objects.exists())
+        self.assertRaises(s3.meta.client.exceptions.ClientError, audio_object.load)
+
+    def test_speech_recognition_reuses_lyrics_of_identical_audio(self):
+        audio = AudioBlob.objects.create(sha256=64 * "0", location=get_audio_key(64 * "0"), size=1,
+                                         lyrics="shared lyrics")
+        song = SongFactory.create(location=audio.location.name, audio=audio)
+
+        with mock.patch("simple_music_service.tasks.recognition.decode_song") as decode_song:
+            recognize_speech_from_file(song.id)
+
+        decode_song.assert_not_called()
+        song.refresh_from_db()
+        self.assertEqual("shared lyrics", song.lyrics)
+
+    @mock_s3
+    def test_can_add_songs_in_bulk(self):
+        authorization(self.client, self.user)
+
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        existing_artist = ArtistFactory.create()
+
+        payload = {
+            "songs[0]title": "first bulk song",
+            "songs[0]year": "2020-12-12",
+            "songs[0]artist_list[0]": existing_artist.name,
+            "songs[0]artist_list[1]": "new artist name",
+            "songs[0]location": SimpleUploadedFile("first-bulk-song.mp3", b"first file body"),
+            "songs[1]title": "second bulk song",
+            "songs[1]year": "2020-12-13",
+            "songs[1]artist_list[0]": "new artist name",
+            "songs[1]location": SimpleUploadedFile("second-bulk-song.mp3", b"second file body"),
+        }
+        response = self.client.post(reverse("nested-song-bulk", args=[self.user.id]), payload)
+
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual(["first bulk song", "second bulk song"], [song["title"] for song in response.data])
+        self.assertEqual([[existing_artist.name, "new artist name"], ["new artist name"]],
+                         [sorted(artist["name"] for artist in song["artist"]) for song in response.data])
+        self.assertEqual(1, Artist.objects.filter(name="new artist name").count())
+        second_song = Song.objects.get(id=response.data[1]["id"])
+        body = s3.Object(self.bucket_name, second_song.location.name).get()["Body"].read()
+        self.assertEqual(b"second file body", body)
+        through_model = Song.artist.through
+        for through in through_model.objects.filter(song__in=[song["id"] for song in response.data]):
+            self.assertTrue(DatabaseAudit.objects.filter(table=through_model._meta.db_table, record_id=through.id,
+                                                         column_name="artist_id", new_value=through.artist_id))
+
+    @mock_s3
+    def test_bulk_song_upload_queries_do_not_depend_on_song_count(self):
+        authorization(self.client, self.user)
+
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+
+        def upload_songs(count, prefix):
+            payload = {}
+            for index in range(count):
+                payload.update({
+                    f"songs[{index}]title": f"{prefix} song {index}",
+                    f"songs[{index}]year": "2020-12-12",
+                    f"songs[{index}]artist_list[0]": f"{prefix} artist {index}",
+                    f"songs[{index}]location": SimpleUploadedFile(f"{prefix}-{index}.mp3", f"{prefix} body".encode()),
+                })
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse("nested-song-bulk", args=[self.user.id]), payload)
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+            return len(queries)
+
+        self.assertEqual(upload_songs(2, "small"), upload_songs(6, "large"))
+
+    def test_cannot_add_empty_song_bulk(self):
+        authorization(self.client, self.user)
+
+        response = self.client.post(reverse("nested-song-bulk", args=[self.user.id]), {}, format="multipart")
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    @mock_s3
+    @override_settings(FEATURE_FLAG_FILE=TEST_FEATURE_FLAG_FILE)
     def test_can_delete_song(self):
         s3 = boto3.resource("s3", region_name="us-east-1")
         s3.create_bucket(Bucket=self.bucket_name)
@@ -245,6 +550,767 @@ class SongViewSetTest(APITestCase):
                     self.assertIn(SongSerializer(instance=song).data, response.data["results"])
 
 
+class SongResponseCacheTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.song = SongFactory.create()
+        cls.user = UserFactory.create()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_song_responses_are_cached(self):
+        for url in [reverse("song-list"), reverse("song-detail", args=[self.song.id])]:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                with self.assertNumQueries(0):
+                    cached_response = self.client.get(url)
+
+                self.assertEqual(status.HTTP_200_OK, cached_response.status_code)
+                self.assertEqual(response.data, cached_response.data)
+
+    def test_song_cache_is_invalidated_by_rating(self):
+        self.client.get(reverse("song-detail", args=[self.song.id]))
+        RatingFactory.create(song=self.song, mark=4)
+
+        response = self.client.get(reverse("song-detail", args=[self.song.id]))
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual("4.0", response.data["average_rating"])
+        self.assertEqual(1, response.data["reviews_count"])
+
+    def test_authenticated_song_responses_are_not_cached(self):
+        RatingFactory.create(song=self.song, user=self.user, mark=5)
+        self.client.get(reverse("song-detail", args=[self.song.id]))
+
+        authorization(self.client, self.user)
+        response = self.client.get(reverse("song-detail", args=[self.song.id]))
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(5, response.data["user_mark"]["mark"])
+
+
+class SparseFieldsetTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.user = UserFactory.create()
+        cls.songs = SongFactory.create_batch(size=3, artist=ArtistFactory.create_batch(size=2))
+        cls.playlist = PlaylistFactory.create(user=cls.user, song=cls.songs)
+        CommentFactory.create_batch(size=2, user=cls.user, song=cls.songs[0])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_can_select_song_fields(self):
+        response = self.client.get(reverse("song-list"), {"fields": "id,title,artist"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        for song in response.data:
+            self.assertEqual(["id", "title", "artist"], list(song.keys()))
+
+    def test_can_omit_song_fields(self):
+        response = self.client.get(reverse("song-detail", args=[self.songs[0].id]), {"omit": "lyrics,user_mark"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotIn("lyrics", response.data)
+        self.assertNotIn("user_mark", response.data)
+        self.assertEqual(2, response.data["comments_count"])
+
+    def test_song_list_with_sparse_fields_runs_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("song-list"), {"fields": "id,title,year"})
+
+        self.assertEqual(len(self.songs), len(response.data))
+
+    def test_can_select_playlist_and_comment_fields(self):
+        authorization(self.client, self.user)
+
+        urls = [
+            (reverse("playlist-list", args=[self.user.id]), ["id", "title"]),
+            (reverse("song-comment-list", args=[self.songs[0].id]), ["id", "message"]),
+            (reverse("user-comment-list", args=[self.user.id]), ["id", "message"]),
+        ]
+        for url, fields in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url, {"fields": ",".join(fields)})
+
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                for item in response.data:
+                    self.assertEqual(fields, list(item.keys()))
+
+
+class SongFastListTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.user = UserFactory.create()
+        cls.songs = SongFactory.create_batch(size=3, artist=ArtistFactory.create_batch(size=2))
+        RatingFactory.create(song=cls.songs[0], user=cls.user, mark=4)
+        RatingFactory.create(song=cls.songs[0], mark=1)
+        RatingFactory.create(song=cls.songs[1], mark=2)
+        RatingFactory.create(song=cls.songs[2], mark=3)
+        CommentFactory.create(song=cls.songs[1])
+        cls.songs[2].lyrics = "first line\u2028second line"
+        cls.songs[2].save()
+        SongRendition.objects.create(song=cls.songs[0], format=SongRendition.MP3, bitrate=64, location="song/64k.mp3")
+        SongRendition.objects.create(song=cls.songs[0], format=SongRendition.HLS, bitrate=64,
+                                     location="song/hls_64k/index.m3u8")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_fast_song_list_matches_serializer_output(self):
+        authorization(self.client, self.user)
+
+        subtest_params = [
+            {},
+            {"ordering": "title"},
+            {"ordering": "-avg_rating", "fields": "id,title,artist,average_rating,user_mark"},
+            {"omit": "lyrics,artist", "search": "title"},
+        ]
+        with mock.patch.object(default_storage, "url", side_effect=lambda name: f"https://storage.test/{name}"):
+            for params in subtest_params:
+                with self.subTest(params=params):
+                    response = self.client.get(reverse("song-list"), params)
+                    request = response.renderer_context["request"]
+                    songs = sorted(self.songs, key=lambda song: song.average_rating, reverse=True) \
+                        if "avg_rating" in params.get("ordering", "") \
+                        else Song.objects.order_by(params.get("ordering", "-year"))
+                    serializer = SongSerializer(songs, many=True, context={"request": request})
+
+                    self.assertEqual(status.HTTP_200_OK, response.status_code)
+                    self.assertEqual(JSONRenderer().render(serializer.data), response.content)
+
+    def test_can_paginate_fast_song_list(self):
+        response = self.client.get(reverse("song-list"), {"page": 2, "page_size": 2})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(len(self.songs), response.data["count"])
+        self.assertEqual([self.songs[0].id], [song["id"] for song in response.data["results"]])
+
+
+class SongUploadTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        cls.user = UserFactory.create()
+        cls.another_user = UserFactory.create()
+
+    def get_upload(self):
+        response = self.client.post(reverse("nested-song-upload_url", args=[self.user.id]))
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        return response.data
+
+    def finalize_upload(self, key):
+        payload = {"title": "uploaded song", "year": "2020-12-12", "artist_list": ["uploaded artist"], "location": key}
+        return self.client.post(reverse("nested-song-finalize_upload", args=[self.user.id]), payload, format="json")
+
+    def upload_song(self, s3, body):
+        key = self.get_upload()["key"]
+        s3.Object(self.bucket_name, key).put(Body=body)
+        response = self.finalize_upload(key)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        return Song.objects.get(id=response.data["id"])
+
+    @mock_s3
+    def test_can_upload_song_directly_to_storage(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+
+        upload = self.get_upload()
+        upload_response = requests.post(upload["url"], data=upload["fields"],
+                                        files={"file": ("song.mp3", b"uploaded file body")})
+        response = self.finalize_upload(upload["key"])
+
+        self.assertTrue(upload["key"].startswith(f"uploads/{self.user.id}/"))
+        self.assertLess(upload_response.status_code, 300)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        song = Song.objects.get(id=response.data["id"])
+        self.assertEqual(upload["key"], song.location.name)
+        self.assertIsNone(song.audio)
+        self.assertEqual(["uploaded artist"], [artist.name for artist in song.artist.all()])
+        self.assertEqual(b"uploaded file body", s3.Object(self.bucket_name, song.location.name).get()["Body"].read())
+
+    @mock_s3
+    def test_identical_uploads_share_audio_after_processing(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        first_song = self.upload_song(s3, b"identical file body")
+        second_song = self.upload_song(s3, b"identical file body")
+        upload_keys = [first_song.location.name, second_song.location.name]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deduplicate_uploaded_song(first_song.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            deduplicate_uploaded_song(second_song.id)
+
+        first_song.refresh_from_db()
+        second_song.refresh_from_db()
+        self.assertEqual(first_song.audio, second_song.audio)
+        self.assertEqual(first_song.audio.location.name, first_song.location.name)
+        self.assertEqual(first_song.location.name, second_song.location.name)
+        self.assertEqual(b"identical file body",
+                         s3.Object(self.bucket_name, first_song.location.name).get()["Body"].read())
+        stored_keys = {summary.key for summary in s3.Bucket(self.bucket_name).objects.all()}
+        self.assertFalse(stored_keys & set(upload_keys))
+
+    @mock_s3
+    def test_cannot_finalize_upload_twice(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        song = self.upload_song(s3, b"uploaded file body")
+
+        repeated_response = self.finalize_upload(song.upload_key)
+        with self.captureOnCommitCallbacks(execute=True):
+            deduplicate_uploaded_song(song.id)
+        processed_response = self.finalize_upload(song.upload_key)
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, repeated_response.status_code)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, processed_response.status_code)
+        self.assertEqual(1, Song.objects.filter(upload_key=song.upload_key).count())
+
+    @mock_s3
+    def test_concurrently_finalized_upload_is_rejected(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        song = self.upload_song(s3, b"uploaded file body")
+
+        # The other request passed validation before this song was created
+        with mock.patch("simple_music_service.uploads.Song.objects.filter") as filter_songs:
+            filter_songs.return_value.exists.return_value = False
+            response = self.finalize_upload(song.upload_key)
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual(1, Song.objects.filter(upload_key=song.upload_key).count())
+
+    @mock_s3
+    @override_settings(SONG_UPLOAD_MAX_SIZE=8)
+    def test_cannot_finalize_invalid_upload(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        oversized_key = self.get_upload()["key"]
+        s3.Object(self.bucket_name, oversized_key).put(Body=b"oversized file body")
+        another_user_key = f"uploads/{self.another_user.id}/song.mp3"
+        s3.Object(self.bucket_name, another_user_key).put(Body=b"body")
+        wrong_extension_key = f"uploads/{self.user.id}/song.wav"
+        s3.Object(self.bucket_name, wrong_extension_key).put(Body=b"body")
+
+        for key in [self.get_upload()["key"], oversized_key, another_user_key, wrong_extension_key]:
+            with self.subTest(key=key):
+                response = self.finalize_upload(key)
+
+                self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+                self.assertFalse(Song.objects.filter(location=key).exists())
+
+    def test_cannot_get_upload_url_for_another_user(self):
+        authorization(self.client, self.user)
+
+        response = self.client.post(reverse("nested-song-upload_url", args=[self.another_user.id]))
+
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+
+class UploadSessionTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        cls.user = UserFactory.create()
+
+    def setUp(self):
+        authorization(self.client, self.user)
+        upload_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(upload_directory.cleanup)
+        settings_override = override_settings(UPLOAD_SESSION_DIR=upload_directory.name,
+                                              UPLOAD_SESSION_BACKEND="simple_music_service.uploads.LocalUploadBackend")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_session(self, size):
+        response = self.client.post(reverse("upload-session-list", args=[self.user.id]), {"size": size})
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        return response.data["id"]
+
+    def put_chunk(self, session_id, chunk, start, size):
+        return self.client.put(reverse("upload-session-detail", args=[self.user.id, session_id]), chunk,
+                               content_type="application/octet-stream",
+                               HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(chunk) - 1}/{size}")
+
+    def complete(self, session_id):
+        payload = {"title": "resumed song", "year": "2020-12-12", "artist_list": ["resumed artist"]}
+        return self.client.post(reverse("upload-session-complete", args=[self.user.id, session_id]), payload,
+                                format="json")
+
+    @mock_s3
+    def test_can_resume_chunked_upload(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        file_body = b"resumable file body"
+        session_id = self.create_session(len(file_body))
+
+        first_response = self.put_chunk(session_id, file_body[:8], 0, len(file_body))
+        repeated_response = self.put_chunk(session_id, file_body[4:12], 4, len(file_body))
+        progress_response = self.client.get(reverse("upload-session-detail", args=[self.user.id, session_id]))
+        last_response = self.put_chunk(session_id, file_body[8:], 8, len(file_body))
+        response = self.complete(session_id)
+
+        self.assertEqual(status.HTTP_200_OK, first_response.status_code)
+        self.assertEqual(status.HTTP_409_CONFLICT, repeated_response.status_code)
+        self.assertEqual(8, repeated_response.data["offset"])
+        self.assertEqual(8, progress_response.data["offset"])
+        self.assertEqual(status.HTTP_200_OK, last_response.status_code)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        song = Song.objects.get(id=response.data["id"])
+        self.assertEqual(["resumed artist"], [artist.name for artist in song.artist.all()])
+        self.assertEqual(file_body, s3.Object(self.bucket_name, song.location.name).get()["Body"].read())
+
+    def test_cannot_complete_unfinished_upload(self):
+        session_id = self.create_session(10)
+        self.put_chunk(session_id, b"12345", 0, 10)
+
+        response = self.complete(session_id)
+
+        self.assertEqual(status.HTTP_409_CONFLICT, response.status_code)
+        self.assertEqual(5, response.data["offset"])
+
+    def test_chunk_stored_concurrently_is_not_recorded_twice(self):
+        session_id = self.create_session(10)
+
+        def upload_concurrent_part(session, part_number, chunk):
+            # Another request for the same range finishes while this chunk is stored
+            UploadSession.objects.filter(id=session.id).update(offset=5, parts=[{"PartNumber": 1, "ETag": "etag"}])
+            return "etag"
+
+        with mock.patch.object(LocalUploadBackend, "upload_part", side_effect=upload_concurrent_part):
+            response = self.put_chunk(session_id, b"12345", 0, 10)
+
+        self.assertEqual(status.HTTP_409_CONFLICT, response.status_code)
+        self.assertEqual(5, response.data["offset"])
+        self.assertEqual(1, len(UploadSession.objects.get(id=session_id).parts))
+
+    def test_stale_upload_sessions_are_aborted(self):
+        stale_session_id = self.create_session(10)
+        self.put_chunk(stale_session_id, b"12345", 0, 10)
+        session_id = self.create_session(10)
+        UploadSession.objects.filter(id=stale_session_id).update(
+            updated_date_time=timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_EXPIRES + 1))
+
+        deleted = delete_stale_upload_sessions()
+
+        self.assertEqual(1, deleted)
+        self.assertEqual([session_id], [str(session.id) for session in UploadSession.objects.all()])
+        self.assertFalse(os.path.exists(os.path.join(settings.UPLOAD_SESSION_DIR, str(stale_session_id))))
+
+    @mock_s3
+    def test_can_upload_chunks_as_multipart_parts(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        file_body = b"a" * (5 * 1024 * 1024) + b"tail"
+
+        with override_settings(UPLOAD_SESSION_BACKEND="simple_music_service.uploads.S3MultipartUploadBackend"):
+            session_id = self.create_session(len(file_body))
+            small_chunk_response = self.put_chunk(session_id, file_body[:1024], 0, len(file_body))
+            self.put_chunk(session_id, file_body[:5 * 1024 * 1024], 0, len(file_body))
+            self.put_chunk(session_id, file_body[5 * 1024 * 1024:], 5 * 1024 * 1024, len(file_body))
+            response = self.complete(session_id)
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, small_chunk_response.status_code)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        song = Song.objects.get(id=response.data["id"])
+        self.assertEqual(len(file_body), s3.Object(self.bucket_name, song.location.name).content_length)
+
+
+class SongStreamTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.song = SongFactory.create(location=SimpleUploadedFile("stream.mp3", b"0123456789"))
+
+    def setUp(self):
+        record_song_play_patcher = mock.patch("simple_music_service.views.record_song_play")
+        self.record_song_play = record_song_play_patcher.start()
+        self.addCleanup(record_song_play_patcher.stop)
+
+    def stream(self, **headers):
+        return self.client.get(reverse("song-stream", args=[self.song.id]), **headers)
+
+    @mock_s3
+    @override_settings(SONG_STREAM_MODE="direct")
+    def test_can_stream_song_ranges(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        s3.Object(self.bucket_name, self.song.location.name).put(Body=b"0123456789")
+
+        subtest_params = [
+            (None, status.HTTP_200_OK, b"0123456789", None),
+            ("bytes=2-5", status.HTTP_206_PARTIAL_CONTENT, b"2345", "bytes 2-5/10"),
+            ("bytes=7-", status.HTTP_206_PARTIAL_CONTENT, b"789", "bytes 7-9/10"),
+            ("bytes=-3", status.HTTP_206_PARTIAL_CONTENT, b"789", "bytes 7-9/10"),
+            ("bytes=10-", status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, b"", "bytes */10"),
+        ]
+        for byte_range, status_code, content, content_range in subtest_params:
+            with self.subTest(byte_range=byte_range):
+                response = self.stream(HTTP_RANGE=byte_range) if byte_range else self.stream()
+
+                self.assertEqual(status_code, response.status_code)
+                self.assertEqual(content, response.getvalue())
+                self.assertEqual(content_range, response.get("Content-Range"))
+
+    @override_settings(SONG_STREAM_MODE="redirect", SONG_STREAM_URL_EXPIRES=120)
+    def test_can_redirect_to_signed_url(self):
+        response = self.stream()
+
+        self.assertEqual(status.HTTP_302_FOUND, response.status_code)
+        self.assertIn(self.song.location.name, response["Location"])
+        self.assertIn("X-Amz-Expires=120", response["Location"])
+
+    @override_settings(SONG_STREAM_MODE="accel")
+    def test_can_delegate_streaming_to_nginx(self):
+        response = self.stream(HTTP_RANGE="bytes=2-5")
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertTrue(response["X-Accel-Redirect"].startswith(
+            f"/protected-songs/{self.bucket_name}.s3.amazonaws.com/{self.song.location.name}?"))
+
+    def test_only_playback_from_start_is_counted(self):
+        self.stream()
+        self.stream(HTTP_RANGE="bytes=0-")
+        self.stream(HTTP_RANGE="bytes=5-")
+
+        self.assertEqual([mock.call(self.song.id)] * 2, self.record_song_play.delay.call_args_list)
+
+
+@skipUnless(which(AudioSegment.converter), "ffmpeg is not installed")
+class TranscodingTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        cls.user = UserFactory.create()
+
+    @mock_s3
+    def test_can_transcode_song_to_renditions(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        with BytesIO() as sound:
+            AudioSegment.silent(duration=25000).export(sound, format="mp3")
+            song = SongFactory.create(location=SimpleUploadedFile("transcoded.mp3", sound.getvalue()))
+
+        transcode_song(song.id)
+        previous_locations = list(song.renditions.values_list("location", flat=True))
+        transcode_song(song.id)
+        response = self.client.get(reverse("song-detail", args=[song.id]))
+
+        self.assertEqual([("hls", 64), ("hls", 128), ("mp3", 64), ("mp3", 128)],
+                         [(rendition["format"], rendition["bitrate"]) for rendition in response.data["renditions"]])
+        for rendition in song.renditions.all():
+            with self.subTest(format=rendition.format, bitrate=rendition.bitrate):
+                body = s3.Object(self.bucket_name, rendition.location.name).get()["Body"].read()
+                if rendition.format == SongRendition.HLS:
+                    segments = [line for line in body.decode().splitlines() if line.endswith(".ts")]
+                    self.assertEqual(3, len(segments))
+                    for segment in segments:
+                        directory = rendition.location.name.rsplit("/", 1)[0]
+                        s3.Object(self.bucket_name, f"{directory}/{segment}").load()
+                else:
+                    self.assertGreater(len(body), 0)
+        for location in previous_locations:
+            self.assertRaises(s3.meta.client.exceptions.ClientError, s3.Object(self.bucket_name, location).load)
+
+    @mock_s3
+    def test_identical_audio_shares_renditions(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        with BytesIO() as sound:
+            AudioSegment.silent(duration=5000).export(sound, format="mp3")
+            song = SongFactory.create(location=SimpleUploadedFile("shared.mp3", sound.getvalue()))
+        audio = AudioBlob.objects.create(sha256=64 * "2", location=song.location.name, size=1)
+        Song.objects.filter(id=song.id).update(audio=audio)
+        identical_song = SongFactory.create(location=song.location.name, audio=audio)
+        transcode_song(song.id)
+
+        with mock.patch("simple_music_service.transcoding.run_ffmpeg") as run_ffmpeg:
+            transcode_song(identical_song.id)
+
+        run_ffmpeg.assert_not_called()
+        locations = sorted(song.renditions.values_list("location", flat=True))
+        self.assertEqual(locations, sorted(identical_song.renditions.values_list("location", flat=True)))
+        Song.objects.get(id=song.id).delete()
+        for location in locations:
+            s3.Object(self.bucket_name, location).load()
+        identical_song.delete()
+        for location in locations:
+            self.assertRaises(s3.meta.client.exceptions.ClientError, s3.Object(self.bucket_name, location).load)
+
+    @mock_s3
+    def test_song_processing_is_scheduled_after_upload(self):
+        authorization(self.client, self.user)
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        payload = {
+            "title": "processed song",
+            "year": "2020-12-12",
+            "artist_list[0]": "processed artist",
+            "location": SimpleUploadedFile("processed.mp3", b"file body"),
+        }
+
+        with mock.patch("simple_music_service.models.app.send_task") as send_task:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse("nested-song-list", args=[self.user.id]), payload)
+
+        send_task.assert_called_once_with("simple_music_service.tasks.process_song", args=[response.data["id"]])
+
+
+@skipUnless(which(AudioSegment.converter), "ffmpeg is not installed")
+class SongWaveformTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+
+    @mock_s3
+    def setUp(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        sound = Sine(440).to_audio_segment(duration=2000, volume=-6) + AudioSegment.silent(duration=2000)
+        with BytesIO() as file:
+            sound.export(file, format="mp3")
+            self.song = SongFactory.create(location=SimpleUploadedFile("waveform.mp3", file.getvalue()))
+        self.waveform = compute_song_waveform(self.song.id)
+
+    def test_can_get_downsampled_waveform(self):
+        response = self.client.get(reverse("song-waveform", args=[self.song.id]), {"buckets": 4})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(4, response.data["buckets"])
+        self.assertAlmostEqual(4000, response.data["duration"], delta=100)
+        peaks = response.data["peaks"]
+        self.assertEqual(8, len(peaks))
+        self.assertTrue(all(abs(peak) > 40 for peak in peaks[:4]))
+        self.assertTrue(all(abs(peak) < 5 for peak in peaks[-2:]))
+
+    def test_can_get_binary_waveform(self):
+        json_response = self.client.get(reverse("song-waveform", args=[self.song.id]), {"buckets": 16})
+        response = self.client.get(reverse("song-waveform", args=[self.song.id]), {"buckets": 16},
+                                   HTTP_ACCEPT="application/octet-stream")
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(json_response.data["peaks"], list(memoryview(response.content).cast("b")))
+
+    def test_identical_audio_shares_waveform(self):
+        audio = AudioBlob.objects.create(sha256=64 * "3", location=self.song.location.name, size=1)
+        Song.objects.filter(id=self.song.id).update(audio=audio)
+        identical_song = SongFactory.create(location=self.song.location.name, audio=audio)
+
+        with mock.patch("simple_music_service.waveforms.AudioSegment.from_file") as from_file:
+            waveform = compute_song_waveform(identical_song.id)
+
+        from_file.assert_not_called()
+        self.assertEqual((self.waveform.duration, bytes(self.waveform.peaks)), (waveform.duration, bytes(waveform.peaks)))
+
+    def test_waveform_is_cacheable(self):
+        response = self.client.get(reverse("song-waveform", args=[self.song.id]))
+        cached_response = self.client.get(reverse("song-waveform", args=[self.song.id]),
+                                          HTTP_IF_NONE_MATCH=response["ETag"])
+
+        self.assertIn("public", response["Cache-Control"])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, cached_response.status_code)
+
+
+class SongMetadataTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.short_song = SongFactory.create(duration=90000, bitrate=128, channels=2, size=1440000)
+        cls.long_song = SongFactory.create(duration=300000, bitrate=320, channels=2, size=12000000)
+        cls.unknown_song = SongFactory.create()
+
+    @mock_s3
+    @skipUnless(which(AudioSegment.converter), "ffmpeg is not installed")
+    def test_can_extract_metadata_from_headers(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        sound = Sine(440).to_audio_segment(duration=3000).set_channels(2).set_frame_rate(44100)
+        with BytesIO() as file:
+            sound.export(file, format="mp3", bitrate="128k", tags={"title": "metadata"})
+            song = SongFactory.create(location=SimpleUploadedFile("metadata.mp3", file.getvalue()))
+            size = len(file.getvalue())
+
+        extract_song_metadata(song.id)
+
+        song.refresh_from_db()
+        self.assertAlmostEqual(3000, song.duration, delta=100)
+        self.assertEqual(128, song.bitrate)
+        self.assertEqual(44100, song.sample_rate)
+        self.assertEqual(2, song.channels)
+        self.assertEqual(size, song.size)
+
+    def test_can_filter_songs_by_duration(self):
+        response = self.client.get(reverse("song-list"), {"max_duration": 120, "fields": "id,duration"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{"id": self.short_song.id, "duration": 90000}], response.data)
+
+    def test_can_filter_songs_by_bitrate_and_size(self):
+        response = self.client.get(reverse("song-list"), {"min_bitrate": 256, "max_size": 20000000, "fields": "id"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{"id": self.long_song.id}], response.data)
+
+    def test_cannot_filter_songs_by_invalid_duration(self):
+        response = self.client.get(reverse("song-list"), {"max_duration": "long"})
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertIn("max_duration", response.data)
+
+
+class LeaderboardViewSetTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.user = UserFactory.create()
+        cls.songs = SongFactory.create_batch(size=3)
+        RatingFactory.create(song=cls.songs[0], mark=2)
+        RatingFactory.create(song=cls.songs[1], mark=5)
+        RatingFactory.create(song=cls.songs[1], mark=4)
+        CommentFactory.create_batch(size=3, song=cls.songs[2])
+        CommentFactory.create(song=cls.songs[0])
+        Comment.objects.filter(song=cls.songs[2]).update(created_date_time=timezone.now() - timedelta(days=3))
+
+    def setUp(self):
+        store_patcher = mock.patch("simple_music_service.leaderboards._store", LocalSortedSetStore())
+        store_patcher.start()
+        self.addCleanup(store_patcher.stop)
+
+    def test_can_get_top_rated_songs(self):
+        response = self.client.get(reverse("leaderboard-detail", args=["top_rated"]), {"fields": "id,title"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{"id": self.songs[1].id, "title": self.songs[1].title, "score": 4.5},
+                          {"id": self.songs[0].id, "title": self.songs[0].title, "score": 2.0}],
+                         response.data["results"])
+
+    def test_trending_songs_count_activity_inside_window(self):
+        day_response = self.client.get(reverse("leaderboard-detail", args=["trending_day"]), {"fields": "id"})
+        week_response = self.client.get(reverse("leaderboard-detail", args=["trending_week"]), {"fields": "id"})
+
+        self.assertEqual([(self.songs[1].id, 2), (self.songs[0].id, 2)],
+                         [(song["id"], song["score"]) for song in day_response.data["results"]])
+        self.assertEqual([(self.songs[2].id, 3), (self.songs[1].id, 2), (self.songs[0].id, 2)],
+                         [(song["id"], song["score"]) for song in week_response.data["results"]])
+
+    def test_leaderboards_are_updated_when_song_is_rated(self):
+        authorization(self.client, self.user)
+        self.client.get(reverse("leaderboard-detail", args=["top_rated"]))
+        self.client.get(reverse("leaderboard-detail", args=["trending_day"]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("song-rating-list", args=[self.songs[2].id]), {"mark": 5})
+        top_rated_response = self.client.get(reverse("leaderboard-detail", args=["top_rated"]), {"limit": 1})
+        trending_response = self.client.get(reverse("leaderboard-detail", args=["trending_day"]))
+
+        self.assertEqual([(self.songs[2].id, 5.0)],
+                         [(song["id"], song["score"]) for song in top_rated_response.data["results"]])
+        self.assertIn((self.songs[2].id, 1),
+                      [(song["id"], song["score"]) for song in trending_response.data["results"]])
+
+    def test_leaderboards_survive_redis_errors(self):
+        authorization(self.client, self.user)
+        failing_store = mock.Mock(**{f"{method}.side_effect": RedisError("Connection refused")
+                                     for method in ["exists", "top", "set_score", "increment"]})
+
+        with mock.patch("simple_music_service.leaderboards._store", failing_store):
+            with self.captureOnCommitCallbacks(execute=True):
+                rating_response = self.client.post(reverse("song-rating-list", args=[self.songs[2].id]), {"mark": 5})
+            response = self.client.get(reverse("leaderboard-detail", args=["top_rated"]), {"fields": "id"})
+
+        self.assertEqual(status.HTTP_201_CREATED, rating_response.status_code)
+        self.assertEqual([(self.songs[2].id, 5.0), (self.songs[1].id, 4.5), (self.songs[0].id, 2.0)],
+                         [(song["id"], song["score"]) for song in response.data["results"]])
+
+    def test_cannot_get_unknown_leaderboard(self):
+        response = self.client.get(reverse("leaderboard-detail", args=["unknown"]))
+
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class RecommendationTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.user = UserFactory.create()
+        cls.songs = SongFactory.create_batch(size=4)
+        first_user, second_user, third_user = UserFactory.create_batch(size=3)
+        RatingFactory.create(song=cls.songs[0], user=cls.user, mark=5)
+        RatingFactory.create(song=cls.songs[0], user=first_user, mark=5)
+        RatingFactory.create(song=cls.songs[1], user=first_user, mark=5)
+        RatingFactory.create(song=cls.songs[0], user=second_user, mark=4)
+        RatingFactory.create(song=cls.songs[1], user=second_user, mark=4)
+        RatingFactory.create(song=cls.songs[2], user=second_user, mark=1)
+        RatingFactory.create(song=cls.songs[2], user=third_user, mark=5)
+        RatingFactory.create(song=cls.songs[3], user=third_user, mark=5)
+        compute_song_similarities()
+
+    def test_similarities_do_not_depend_on_block_size(self):
+        similarities = set(SongSimilarity.objects.values_list("song", "similar_song"))
+
+        compute_song_similarities(block_size=1, neighbours=1)
+
+        self.assertEqual({(self.songs[0].id, self.songs[1].id), (self.songs[1].id, self.songs[0].id),
+                          (self.songs[2].id, self.songs[3].id), (self.songs[3].id, self.songs[2].id)},
+                         set(SongSimilarity.objects.values_list("song", "similar_song")))
+        self.assertEqual(8, len(similarities))
+
+    def test_can_get_similar_songs(self):
+        response = self.client.get(reverse("song-similar", args=[self.songs[0].id]), {"fields": "id,title"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.songs[1].id, self.songs[2].id], [song["id"] for song in response.data])
+        self.assertGreater(response.data[0]["score"], response.data[1]["score"])
+
+    def test_can_get_recommendations(self):
+        authorization(self.client, self.user)
+
+        response = self.client.get(reverse("applicationuser-recommendations", args=[self.user.id]))
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.songs[1].id, self.songs[2].id], [song["id"] for song in response.data])
+
+    def test_cannot_get_recommendations_of_another_user(self):
+        authorization(self.client, self.user)
+        another_user = UserFactory.create()
+
+        response = self.client.get(reverse("applicationuser-recommendations", args=[another_user.id]))
+
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+
 class PlaylistViewSetTest(APITestCase):
     @classmethod
     @mock_s3
@@ -298,7 +1364,7 @@ class PlaylistViewSetTest(APITestCase):
         self.assertEqual(len(payload["song"]), len(created_playlist.song.all()))
         for i, payload_song in enumerate(payload["song"]):
             self.assertEqual(payload["song"][i]["id"], response.data["song"][i]["id"])
-            self.assertEqual(payload["song"][i]["id"], created_playlist.song.all()[i].id)
+            self.assertEqual(payload["song"][i]["id"], created_playlist.song.order_by("id")[i].id)
 
     def test_can_edit_playlist(self):
         authorization(self.client, self.user)
@@ -331,7 +1397,7 @@ class PlaylistViewSetTest(APITestCase):
         self.assertEqual(len(payload["song"]), len(created_playlist.song.all()))
         for i in range(0, len(payload["song"])):
             self.assertEqual(payload["song"][i]["id"], response.data["song"][i]["id"])
-            self.assertEqual(payload["song"][i]["id"], created_playlist.song.all()[i].id)
+            self.assertEqual(payload["song"][i]["id"], created_playlist.song.order_by("id")[i].id)
 
     def test_can_delete_playlist(self):
         authorization(self.client, self.user)
@@ -556,6 +1622,110 @@ class CommentViewSetTest(APITestCase):
                     self.assertIn(CommentForUserSerializer(instance=comment).data, response.data["results"])
 
 
+class ConditionalRequestTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.user = UserFactory.create()
+        cls.song = SongFactory.create()
+        cls.playlist = PlaylistFactory.create(user=cls.user, song=[cls.song])
+        cls.comments = CommentFactory.create_batch(size=2, user=cls.user, song=cls.song)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_can_get_not_modified_response_for_matching_etag(self):
+        authorization(self.client, self.user)
+
+        urls = [
+            reverse("song-list"),
+            reverse("song-detail", args=[self.song.id]),
+            reverse("playlist-list", args=[self.user.id]),
+            reverse("playlist-detail", args=[self.user.id, self.playlist.id]),
+            reverse("song-comment-list", args=[self.song.id]),
+            reverse("song-comment-detail", args=[self.song.id, self.comments[0].id]),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                not_modified_response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertEqual(status.HTTP_304_NOT_MODIFIED, not_modified_response.status_code)
+
+    def test_song_etag_changes_after_rating(self):
+        url = reverse("song-detail", args=[self.song.id])
+        etag = self.client.get(url)["ETag"]
+        RatingFactory.create(song=self.song, mark=2)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+
+    def test_etags_change_before_signed_urls_expire(self):
+        authorization(self.client, self.user)
+        urls = [
+            reverse("song-list"),
+            reverse("song-detail", args=[self.song.id]),
+            reverse("playlist-list", args=[self.user.id]),
+            reverse("playlist-detail", args=[self.user.id, self.playlist.id]),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                etag = self.client.get(url)["ETag"]
+
+                with mock.patch("simple_music_service.conditions.time.time",
+                                return_value=time.time() + settings.AWS_QUERYSTRING_EXPIRE):
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertNotEqual(etag, response["ETag"])
+
+    def test_playlist_etag_changes_after_edit(self):
+        authorization(self.client, self.user)
+        url = reverse("playlist-detail", args=[self.user.id, self.playlist.id])
+        etag = self.client.get(url)["ETag"]
+        self.client.patch(url, {"title": "new playlist title", "song": []}, format="json")
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual("new playlist title", response.data["title"])
+
+    def test_can_get_not_modified_comment_since_last_modified(self):
+        url = reverse("song-comment-detail", args=[self.song.id, self.comments[0].id])
+        response = self.client.get(url)
+        not_modified_response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, not_modified_response.status_code)
+
+    def test_comment_list_changes_after_newest_comment_is_deleted(self):
+        url = reverse("song-comment-list", args=[self.song.id])
+        response = self.client.get(url)
+        Comment.objects.filter(id=self.comments[-1].id).delete()
+
+        changed_response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"],
+                                           HTTP_IF_MODIFIED_SINCE=timezone.now().strftime("%a, %d %b %Y %H:%M:%S GMT"))
+
+        self.assertNotIn("Last-Modified", response)
+        self.assertEqual(status.HTTP_200_OK, changed_response.status_code)
+        self.assertEqual(1, len(changed_response.data))
+
+    def test_etag_differs_per_renderer(self):
+        url = reverse("song-detail", args=[self.song.id])
+        json_response = self.client.get(url, HTTP_ACCEPT="application/json")
+
+        html_response = self.client.get(url, HTTP_ACCEPT="text/html", HTTP_IF_NONE_MATCH=json_response["ETag"])
+
+        self.assertEqual(status.HTTP_200_OK, html_response.status_code)
+        self.assertNotEqual(json_response["ETag"], html_response["ETag"])
+
+
 def authorization(client, user):
     access = AccessToken.for_user(user)
     client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
@@ -674,3 +1844,395 @@ class DataBaseAuditTestCase(APITestCase):
                 for attribute in instance_attributes:
                     self.is_exist_record(instance, attribute, old_value=instance_created_data[attribute],
                                          new_value=instance_updated_data[attribute])
+
+
+@override_settings(SPEECH_RECOGNITION_RETRY_DELAY=0)
+class SpeechRecognitionTest(APITestCase):
+    def test_recognized_chunks_keep_their_order(self):
+        def recognize_google(audio):
+            # Later chunks finish first
+            time.sleep((10 - audio) * 0.002)
+            return f"chunk {audio}"
+
+        recognizer = mock.Mock(recognize_google=mock.Mock(side_effect=recognize_google))
+
+        texts = list(recognize_chunks(recognizer, range(10), workers=4))
+
+        self.assertEqual([f"chunk {index}" for index in range(10)], texts)
+
+    def test_chunks_are_normalized_and_padded(self):
+        time_points = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+        speech = (np.sin(2 * np.pi * 440 * time_points) * 3000 * (time_points > 0.5)).astype(np.int16)
+        noise = np.random.default_rng(0).normal(0, 50, SAMPLE_RATE).astype(np.int16)
+
+        noise_floor = NoiseFloorTracker()
+        noise_floor.update(get_frame_levels(speech + noise))
+        audio_chunks = [get_audio_data(normalize_samples(samples, noise_floor.level))
+                        for samples in [speech + noise, noise]]
+
+        speech_samples = np.frombuffer(audio_chunks[0].frame_data, dtype="<i2")
+        noise_samples = np.frombuffer(audio_chunks[1].frame_data, dtype="<i2")
+        self.assertEqual((SAMPLE_RATE, SAMPLE_WIDTH), (audio_chunks[0].sample_rate, audio_chunks[0].sample_width))
+        self.assertEqual(SAMPLE_RATE + 2 * PADDING, len(speech_samples))
+        self.assertFalse(speech_samples[:PADDING].any() or speech_samples[-PADDING:].any())
+        self.assertGreater(np.abs(speech_samples).max(), 25000)
+        self.assertTrue(np.array_equal(noise, noise_samples[PADDING:-PADDING]))
+
+    def test_speech_is_chunked_at_pauses(self):
+        def speech(milliseconds):
+            time_points = np.arange(SAMPLE_RATE * milliseconds // 1000) / SAMPLE_RATE
+            return (np.sin(2 * np.pi * 440 * time_points) * 5000).astype(np.int16)
+
+        def silence(milliseconds):
+            return np.zeros(SAMPLE_RATE * milliseconds // 1000, dtype=np.int16)
+
+        samples = np.concatenate([silence(3000), speech(2000), silence(300), speech(2000), silence(400), speech(3000),
+                                  silence(3000), speech(1000), silence(5000)])
+        blocks = np.array_split(samples, 7)
+
+        chunks = list(split_file_to_chunks(blocks, chunk_size=6000))
+
+        # The first pauses are merged until the chunk is full, the long silences are skipped
+        self.assertEqual([4700, 3400, 1400], [len(chunk) * 1000 // SAMPLE_RATE for chunk in chunks])
+        self.assertEqual([], list(split_file_to_chunks([silence(10000)])))
+
+    def test_speech_after_loud_intro_is_not_skipped(self):
+        time_points = np.arange(SAMPLE_RATE * 6) / SAMPLE_RATE
+        intro = (np.sin(2 * np.pi * 220 * time_points) * 20000).astype(np.int16)
+        speech = (np.sin(2 * np.pi * 440 * time_points[:SAMPLE_RATE * 2]) * 2000).astype(np.int16)
+        verse = np.concatenate([np.zeros(SAMPLE_RATE, dtype=np.int16), speech,
+                                np.zeros(SAMPLE_RATE * 3, dtype=np.int16)])
+        blocks = [intro, verse, np.zeros(SAMPLE_RATE * 6, dtype=np.int16)]
+
+        chunks = [(samples, end) for samples, end in split_speech(blocks, 6000) if end > len(intro)]
+
+        # The speech with the silence kept around it
+        self.assertEqual([2400], [len(samples) * 1000 // SAMPLE_RATE for samples, _ in chunks])
+
+    def test_vocals_over_music_bed_are_not_skipped(self):
+        time_points = np.arange(SAMPLE_RATE * 30) / SAMPLE_RATE
+        music_bed = np.random.default_rng(0).normal(0, 2000, len(time_points))
+        vocals = np.sin(2 * np.pi * 440 * time_points) * 3000 * (time_points >= 6)
+        samples = (music_bed + vocals).astype(np.int16)
+
+        chunks = list(split_file_to_chunks(np.array_split(samples, 5), chunk_size=6000))
+
+        self.assertEqual([6000] * 5, [len(chunk) * 1000 // SAMPLE_RATE for chunk in chunks])
+
+    def test_long_speech_is_chunked_at_maximum_size(self):
+        sound = Sine(440).to_audio_segment(duration=15000, volume=-6)
+
+        chunks = list(split_file_to_chunks(sound, chunk_size=6000, noise_floor=0))
+
+        self.assertEqual([6000, 6000, 3000], [len(chunk) for chunk in chunks])
+
+    def test_engine_recognizes_chunks_in_batches(self):
+        class BatchEngine(BatchRecognitionEngine):
+            batch_size = 2
+            batches = []
+
+            def recognize_batch(self, batch):
+                self.batches.append(list(batch))
+                return [f"chunk {audio}" for audio in batch]
+
+        texts = list(BatchEngine().recognize(range(5)))
+
+        self.assertEqual([f"chunk {index}" for index in range(5)], texts)
+        self.assertEqual([[0, 1], [2, 3], [4]], BatchEngine.batches)
+
+    def test_engine_is_preloaded_only_in_recognition_workers(self):
+        with mock.patch("simple_music_service.tasks.recognition.get_recognition_engine") as get_engine:
+            with override_settings(SPEECH_RECOGNITION_PRELOAD=False):
+                preload_recognition_engine()
+            get_engine.assert_not_called()
+            with override_settings(SPEECH_RECOGNITION_PRELOAD=True):
+                preload_recognition_engine()
+            get_engine.assert_called_once_with()
+
+    @override_settings(SPEECH_RECOGNITION_ENGINE="simple_music_service.recognition.BatchRecognitionEngine")
+    def test_incomplete_engine_fails_when_created(self):
+        with self.assertRaises(TypeError):
+            get_recognition_engine()
+
+    def test_failed_chunk_requests_are_retried(self):
+        attempts = {}
+
+        def recognize_google(audio):
+            attempts[audio] = attempts.get(audio, 0) + 1
+            if audio == "unclear":
+                raise UnknownValueError()
+            if audio == "unavailable" or attempts[audio] == 1:
+                raise RequestError("recognition connection failed")
+            return audio
+
+        recognizer = mock.Mock(recognize_google=mock.Mock(side_effect=recognize_google))
+
+        with override_settings(SPEECH_RECOGNITION_RETRIES=2):
+            texts = list(recognize_chunks(recognizer, ["flaky", "unclear", "unavailable"], workers=2))
+
+        self.assertEqual(["flaky", None, FAILED], texts)
+        self.assertEqual({"flaky": 2, "unclear": 1, "unavailable": 3}, attempts)
+
+    def test_timed_out_chunk_does_not_stop_recognition(self):
+        def recognize_google(audio):
+            if audio == "slow":
+                raise socket.timeout("timed out")
+            return audio
+
+        recognizer = mock.Mock(recognize_google=mock.Mock(side_effect=recognize_google))
+
+        with override_settings(SPEECH_RECOGNITION_RETRIES=1):
+            texts = list(recognize_chunks(recognizer, ["first", "slow", "last"], workers=2))
+
+        self.assertEqual(["first", FAILED, "last"], texts)
+        self.assertEqual(4, recognizer.recognize_google.call_count)
+
+
+@skipUnless(which(AudioSegment.converter), "ffmpeg is not installed")
+class StreamingSpeechRecognitionTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+
+    def create_song(self):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=self.bucket_name)
+        tone = Sine(440).to_audio_segment(duration=2000, volume=-6)
+        sound = (AudioSegment.silent(duration=1000) + tone + AudioSegment.silent(duration=2000) + tone).set_channels(2)
+        with BytesIO() as file:
+            sound.export(file, format="mp3")
+            return SongFactory.create(location=SimpleUploadedFile("speech.mp3", file.getvalue()))
+
+    @mock_s3
+    def test_song_is_decoded_in_fixed_size_chunks(self):
+        chunks = list(decode_song(self.create_song(), chunk_size=2000))
+
+        self.assertEqual(4, len(chunks))
+        for chunk in chunks[:-1]:
+            self.assertEqual(2 * SAMPLE_RATE, len(chunk))
+        self.assertAlmostEqual(7 * SAMPLE_RATE, sum(len(chunk) for chunk in chunks), delta=SAMPLE_RATE // 10)
+
+    @mock_s3
+    def test_can_recognize_speech_from_streamed_song(self):
+        song = self.create_song()
+
+        with mock.patch("speech_recognition.Recognizer.recognize_google", return_value="words") as recognize_google:
+            recognize_speech_from_file(song.id)
+
+        song.refresh_from_db()
+        self.assertEqual(2, recognize_google.call_count)
+        self.assertEqual("words words", song.lyrics)
+
+    @mock_s3
+    @override_settings(SPEECH_RECOGNITION_ENGINE="simple_music_service.recognition.FakeRecognitionEngine")
+    def test_can_recognize_speech_with_offline_engine(self):
+        song = self.create_song()
+
+        recognize_speech_from_file(song.id)
+
+        song.refresh_from_db()
+        # Every chunk is 2 seconds of speech with its surrounding silence
+        self.assertEqual(" ".join(["word"] * 6), song.lyrics)
+        chunks = list(RecognitionChunk.objects.filter(job__song=song))
+        self.assertEqual([0, 1], [chunk.index for chunk in chunks])
+        self.assertEqual(["word word word"] * 2, [chunk.text for chunk in chunks])
+        self.assertLess(chunks[0].end_time, chunks[1].end_time)
+        self.assertEqual(100, RecognitionJob.objects.get(song=song).progress)
+
+
+class RecognitionJobTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        cls.bucket_name = "simple-music-service-storage"
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=cls.bucket_name)
+        cls.song = SongFactory.create()
+
+    def setUp(self):
+        delay_patcher = mock.patch("simple_music_service.tasks.recognize_speech_from_file.delay")
+        self.delay = delay_patcher.start()
+        self.addCleanup(delay_patcher.stop)
+
+    def request_recognition(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.get(reverse("song-recognize_speech", args=[self.song.id]))
+
+    def test_repeated_requests_queue_one_job(self):
+        responses = [self.request_recognition() for _ in range(3)]
+
+        self.assertEqual([status.HTTP_202_ACCEPTED] * 3, [response.status_code for response in responses])
+        self.assertEqual([RecognitionJob.QUEUED] * 3, [response.data["status"] for response in responses])
+        self.delay.assert_called_once_with(self.song.id)
+
+    def test_running_job_is_accepted(self):
+        RecognitionJob.objects.create(song=self.song, status=RecognitionJob.RUNNING, task_id="running", attempts=1)
+
+        response = self.request_recognition()
+
+        self.assertEqual(status.HTTP_202_ACCEPTED, response.status_code)
+        self.assertEqual(RecognitionJob.RUNNING, response.data["status"])
+        self.assertNotIn("lyrics", response.data)
+        self.delay.assert_not_called()
+
+    def test_finished_job_returns_lyrics(self):
+        job = RecognitionJob.objects.create(song=self.song, status=RecognitionJob.DONE, task_id="done", attempts=1)
+
+        def finish_job(song_id):
+            # The task saves the lyrics after the view read the song
+            Song.objects.filter(id=song_id).update(lyrics="recognized words")
+            return job
+
+        with mock.patch("simple_music_service.views.request_speech_recognition", side_effect=finish_job):
+            response = self.request_recognition()
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(RecognitionJob.DONE, response.data["status"])
+        self.assertEqual("recognized words", response.data["lyrics"])
+        self.delay.assert_not_called()
+
+    def test_recognized_song_returns_lyrics(self):
+        Song.objects.filter(id=self.song.id).update(lyrics="known words")
+
+        response = self.request_recognition()
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual((RecognitionJob.DONE, "known words"), (response.data["status"], response.data["lyrics"]))
+        self.delay.assert_not_called()
+
+    def test_expired_job_is_queued_again(self):
+        RecognitionJob.objects.create(song=self.song, status=RecognitionJob.RUNNING, task_id="lost", attempts=1)
+        RecognitionJob.objects.update(updated_date_time=timezone.now() - timedelta(hours=2))
+
+        response = self.request_recognition()
+
+        self.assertEqual(RecognitionJob.QUEUED, response.data["status"])
+        self.assertEqual(2, RecognitionJob.objects.get(song=self.song).attempts)
+        self.delay.assert_called_once_with(self.song.id)
+
+    def test_task_skips_job_running_elsewhere(self):
+        RecognitionJob.objects.create(song=self.song, status=RecognitionJob.RUNNING, task_id="running", attempts=1)
+
+        with mock.patch("simple_music_service.tasks.recognition.get_audio_chunks") as get_audio_chunks:
+            recognize_speech_from_file(self.song.id)
+
+        get_audio_chunks.assert_not_called()
+        self.assertEqual(RecognitionJob.RUNNING, RecognitionJob.objects.get(song=self.song).status)
+
+    @override_settings(SPEECH_RECOGNITION_ENGINE="simple_music_service.recognition.FakeRecognitionEngine")
+    def test_task_completes_queued_job(self):
+        self.request_recognition()
+
+        with mock.patch("simple_music_service.tasks.recognition.get_audio_chunks", return_value=[]):
+            recognize_speech_from_file(self.song.id)
+
+        job = RecognitionJob.objects.get(song=self.song)
+        self.assertEqual(RecognitionJob.DONE, job.status)
+        self.song.refresh_from_db()
+        self.assertEqual("", self.song.lyrics)
+
+    def create_song_with_audio(self):
+        audio = AudioBlob.objects.create(sha256=64 * "1", location=get_audio_key(64 * "1"), size=1)
+        return SongFactory.create(location=audio.location.name, audio=audio)
+
+    def test_decoding_error_fails_job_without_saving_lyrics(self):
+        song = self.create_song_with_audio()
+
+        def recognize_song(song):
+            yield "first words", 1000
+            raise subprocess.CalledProcessError(1, "ffmpeg")
+
+        with mock.patch("simple_music_service.tasks.recognition.recognize_song", side_effect=recognize_song):
+            self.assertRaises(subprocess.CalledProcessError, recognize_speech_from_file, song.id)
+
+        song.refresh_from_db()
+        self.assertIsNone(song.lyrics)
+        self.assertIsNone(AudioBlob.objects.get(id=song.audio_id).lyrics)
+        self.assertEqual(RecognitionJob.FAILED, RecognitionJob.objects.get(song=song).status)
+
+    def test_lyrics_with_failed_chunks_are_not_shared(self):
+        song = self.create_song_with_audio()
+        texts = [("first words", 1000), (FAILED, 2000), ("last words", 3000)]
+
+        with mock.patch("simple_music_service.tasks.recognition.recognize_song", return_value=texts):
+            recognize_speech_from_file(song.id)
+
+        song.refresh_from_db()
+        self.assertEqual("first words last words", song.lyrics)
+        self.assertIsNone(AudioBlob.objects.get(id=song.audio_id).lyrics)
+        self.assertEqual([None], [chunk.text for chunk in RecognitionChunk.objects.filter(index=1)])
+
+
+class TaskRoutingTest(APITestCase):
+    def get_queue(self, task_name):
+        return celery_app.amqp.router.route({}, f"simple_music_service.tasks.{task_name}")["queue"].name
+
+    def test_tasks_are_routed_to_their_queues(self):
+        self.assertEqual("email", self.get_queue("send_outbox_emails"))
+        self.assertEqual("media", self.get_queue("transcode_song"))
+        self.assertEqual("recognition", self.get_queue("recognize_speech_from_file"))
+        self.assertEqual("celery", self.get_queue("record_song_play"))
+
+    def test_recognition_is_acknowledged_late_within_the_visibility_timeout(self):
+        self.assertTrue(recognize_speech_from_file.acks_late)
+        self.assertLess(recognize_speech_from_file.soft_time_limit, recognize_speech_from_file.time_limit)
+        self.assertLess(recognize_speech_from_file.time_limit, settings.BROKER_TRANSPORT_OPTIONS["visibility_timeout"])
+
+
+class RecognitionEventsTest(APITestCase):
+    @classmethod
+    @mock_s3
+    def setUpTestData(cls):
+        s3 = boto3.resource("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="simple-music-service-storage")
+        cls.song = SongFactory.create()
+
+    def get_events(self, song_id, headers=()):
+        communicator = ApplicationCommunicator(application, {
+            "type": "http", "method": "GET", "path": f"/songs/{song_id}/recognize_speech/events/", "query_string": b"",
+            "headers": list(headers), "scheme": "http", "server": ("testserver", 80),
+        })
+
+        async def receive_response():
+            await communicator.send_input({"type": "http.request"})
+            start = await communicator.receive_output(timeout=5)
+            body = b""
+            while True:
+                message = await communicator.receive_output(timeout=5)
+                body += message.get("body", b"")
+                if not message.get("more_body"):
+                    return start, body
+
+        return async_to_sync(receive_response)()
+
+    def test_finished_job_streams_its_chunks(self):
+        job = RecognitionJob.objects.create(song=self.song, status=RecognitionJob.DONE, progress=100)
+        RecognitionChunk.objects.create(job=job, index=0, text="hello", end_time=1500)
+        RecognitionChunk.objects.create(job=job, index=1, text=None, end_time=3000)
+        Song.objects.filter(id=self.song.id).update(lyrics="hello")
+
+        start, body = self.get_events(self.song.id)
+
+        self.assertEqual(status.HTTP_200_OK, start["status"])
+        self.assertIn((b"content-type", b"text/event-stream"), start["headers"])
+        self.assertEqual(
+            b'event: chunk\ndata: {"index":0,"text":"hello","end_time":1500}\n\n'
+            b'event: chunk\ndata: {"index":1,"text":null,"end_time":3000}\n\n'
+            b'event: progress\ndata: {"status":"done","progress":100}\n\n'
+            b'event: done\ndata: {"lyrics":"hello"}\n\n', body)
+
+    @override_settings(CORS_ALLOWED_ORIGINS=["http://frontend.example"])
+    def test_events_allow_cross_origin_requests_from_allowed_origins(self):
+        RecognitionJob.objects.create(song=self.song, status=RecognitionJob.DONE, progress=100)
+
+        start, _ = self.get_events(self.song.id, [(b"origin", b"http://frontend.example")])
+        other_start, _ = self.get_events(self.song.id, [(b"origin", b"http://other.example")])
+
+        self.assertIn((b"access-control-allow-origin", b"http://frontend.example"), start["headers"])
+        self.assertIn((b"vary", b"Origin"), start["headers"])
+        self.assertNotIn(b"access-control-allow-origin", [name for name, _ in other_start["headers"]])
+
+    def test_events_of_unknown_song_are_not_found(self):
+        start, _ = self.get_events(self.song.id + 1)
+
+        self.assertEqual(status.HTTP_404_NOT_FOUND, start["status"])
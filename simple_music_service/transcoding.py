@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import logging
+from uuid import uuid4
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from pydub import AudioSegment
+from .models import Song, SongRendition
+
+logger = logging.getLogger("django")
+
+
+def transcode_song(song_id):
+    try:
+        song = Song.objects.get(id=song_id)
+    except Song.DoesNotExist:
+        logger.info(f"Song {song_id} was deleted before transcoding")
+        return []
+
+    renditions = get_shared_renditions(song)
+    if renditions:
+        logger.info(f"Reused renditions of identical audio for song {song_id}")
+    else:
+        renditions = create_renditions(song)
+
+    with transaction.atomic():
+        previous_renditions = list(song.renditions.all())
+        for rendition in previous_renditions:
+            rendition.delete()
+        for rendition in renditions:
+            rendition.save()
+    for rendition in previous_renditions:
+        rendition.delete_files()
+    logger.info(f"Created {len(renditions)} renditions for song {song_id}")
+    return renditions
+
+
+def get_shared_renditions(song):
+    """Returns copies of the renditions of another song with identical audio, which share their files."""
+    if song.audio_id is None:
+        return []
+    sibling_id = SongRendition.objects.filter(song__audio=song.audio_id).exclude(song=song) \
+        .values_list("song", flat=True).first()
+    if sibling_id is None:
+        return []
+    return [SongRendition(song=song, format=rendition.format, bitrate=rendition.bitrate,
+                          location=rendition.location.name)
+            for rendition in SongRendition.objects.filter(song=sibling_id)]
+
+
+def create_renditions(song):
+    storage = song.location.storage
+    # Every run writes under a fresh prefix, so HLS playlists never reference segments renamed by the storage
+    prefix = f"{os.path.splitext(song.location.name)[0]}_renditions/{uuid4().hex[:12]}"
+    renditions = []
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "source")
+        with song.location.open("rb") as source, open(source_path, "wb") as source_file:
+            shutil.copyfileobj(source, source_file)
+
+        for bitrate in settings.SONG_RENDITION_BITRATES:
+            mp3_path = os.path.join(directory, f"{bitrate}k.mp3")
+            run_ffmpeg("-i", source_path, "-vn", "-c:a", "libmp3lame", "-b:a", f"{bitrate}k", mp3_path)
+            mp3_name = save_file(storage, f"{prefix}/{bitrate}k.mp3", mp3_path)
+            renditions.append(SongRendition(song=song, format=SongRendition.MP3, bitrate=bitrate, location=mp3_name))
+
+            hls_directory = os.path.join(directory, f"hls_{bitrate}k")
+            os.mkdir(hls_directory)
+            run_ffmpeg("-i", mp3_path, "-c:a", "copy", "-f", "hls",
+                       "-hls_time", str(settings.SONG_HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+                       "-hls_segment_filename", os.path.join(hls_directory, "segment_%05d.ts"),
+                       os.path.join(hls_directory, "index.m3u8"))
+            playlist_name = save_hls_files(storage, f"{prefix}/hls_{bitrate}k", hls_directory)
+            renditions.append(SongRendition(song=song, format=SongRendition.HLS, bitrate=bitrate,
+                                            location=playlist_name))
+    return renditions
+
+
+def run_ffmpeg(*args):
+    subprocess.run([AudioSegment.converter, "-y", "-loglevel", "error", *args], check=True, capture_output=True)
+
+
+def save_file(storage, name, path):
+    with open(path, "rb") as file:
+        return storage.save(name, File(file))
+
+
+def save_hls_files(storage, directory_name, directory):
+    # Segments go first so the playlist never points at objects that are not stored yet
+    for file_name in sorted(os.listdir(directory)):
+        if file_name != "index.m3u8":
+            save_file(storage, f"{directory_name}/{file_name}", os.path.join(directory, file_name))
+    return save_file(storage, f"{directory_name}/index.m3u8", os.path.join(directory, "index.m3u8"))
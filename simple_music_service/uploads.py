@@ -0,0 +1,313 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import logging
+from datetime import timedelta
+from uuid import uuid4
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Song, AudioBlob, UploadSession
+from .streaming import read_range
+
+logger = logging.getLogger("django")
+
+UPLOAD_KEY_PREFIX = "uploads/{user_id}/"
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+def get_song_storage():
+    return Song._meta.get_field("location").storage
+
+
+def get_upload_key(user_id, extension="mp3"):
+    return f"{UPLOAD_KEY_PREFIX.format(user_id=user_id)}{uuid4().hex}.{extension}"
+
+
+def get_audio_key(sha256, extension="mp3"):
+    return f"audio/{sha256[:2]}/{sha256}.{extension}"
+
+
+def create_presigned_upload(user_id):
+    storage = get_song_storage()
+    key = get_upload_key(user_id)
+    fields = {"Content-Type": "audio/mpeg"}
+    conditions = [{"Content-Type": "audio/mpeg"}, ["content-length-range", 1, settings.SONG_UPLOAD_MAX_SIZE]]
+    if storage.default_acl:
+        fields["acl"] = storage.default_acl
+        conditions.append({"acl": storage.default_acl})
+    presigned_post = storage.connection.meta.client.generate_presigned_post(
+        Bucket=storage.bucket_name,
+        Key=key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=settings.SONG_UPLOAD_EXPIRES,
+    )
+    return {"key": key, "url": presigned_post["url"], "fields": presigned_post["fields"]}
+
+
+def verify_uploaded_song(key, user_id):
+    if not key.startswith(UPLOAD_KEY_PREFIX.format(user_id=user_id)) or ".." in key:
+        raise ValidationError("Unknown upload key.")
+    location_field = Song._meta.get_field("location")
+    location_field.run_validators(location_field.attr_class(None, location_field, key))
+    if Song.objects.filter(upload_key=key).exists():
+        raise ValidationError("This upload has already been finalized.")
+
+    try:
+        size = get_song_storage().size(key)
+    except ClientError:
+        raise ValidationError("The file has not been uploaded.")
+    if size > settings.SONG_UPLOAD_MAX_SIZE:
+        raise ValidationError(f"Ensure the file size is not greater than {settings.SONG_UPLOAD_MAX_SIZE} bytes.")
+    return size
+
+
+class S3MultipartUploadBackend:
+    # S3 rejects multipart parts below 5 MiB unless it is the last one
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self):
+        self.storage = get_song_storage()
+        self.client = self.storage.connection.meta.client
+
+    def start(self, session):
+        parameters = {"ACL": self.storage.default_acl} if self.storage.default_acl else {}
+        upload = self.client.create_multipart_upload(Bucket=self.storage.bucket_name, Key=session.key,
+                                                     ContentType="audio/mpeg", **parameters)
+        return upload["UploadId"]
+
+    def upload_part(self, session, part_number, chunk):
+        part = self.client.upload_part(Bucket=self.storage.bucket_name, Key=session.key, UploadId=session.upload_id,
+                                       PartNumber=part_number, Body=chunk)
+        return part["ETag"]
+
+    def complete(self, session):
+        self.client.complete_multipart_upload(Bucket=self.storage.bucket_name, Key=session.key,
+                                              UploadId=session.upload_id, MultipartUpload={"Parts": session.parts})
+        return session.key
+
+    def abort(self, session):
+        self.client.abort_multipart_upload(Bucket=self.storage.bucket_name, Key=session.key,
+                                           UploadId=session.upload_id)
+
+
+class LocalUploadBackend:
+    """Keeps parts on local disk and saves the assembled file to the song storage on completion."""
+
+    min_part_size = 1
+
+    def __init__(self):
+        self.storage = get_song_storage()
+
+    @staticmethod
+    def get_session_directory(session):
+        return os.path.join(settings.UPLOAD_SESSION_DIR, str(session.id))
+
+    def start(self, session):
+        os.makedirs(self.get_session_directory(session), exist_ok=True)
+        return None
+
+    def upload_part(self, session, part_number, chunk):
+        etag = hashlib.md5()
+        with open(os.path.join(self.get_session_directory(session), f"{part_number:05d}"), "wb") as part_file:
+            for block in iter(lambda: chunk.read(64 * 1024), b""):
+                etag.update(block)
+                part_file.write(block)
+        return etag.hexdigest()
+
+    def complete(self, session):
+        directory = self.get_session_directory(session)
+        with tempfile.TemporaryFile() as song_file:
+            for part in session.parts:
+                with open(os.path.join(directory, f"{part['PartNumber']:05d}"), "rb") as part_file:
+                    shutil.copyfileobj(part_file, song_file)
+            song_file.seek(0)
+            key = self.storage.save(session.key, File(song_file))
+        shutil.rmtree(directory, ignore_errors=True)
+        return key
+
+    def abort(self, session):
+        shutil.rmtree(self.get_session_directory(session), ignore_errors=True)
+
+
+def delete_stale_upload_sessions():
+    """Aborts upload sessions idle for longer than UPLOAD_SESSION_EXPIRES and deletes them.
+
+    S3 keeps the parts of multipart uploads that are never completed or aborted, and bills them, so buckets should
+    also have an AbortIncompleteMultipartUpload lifecycle rule for uploads whose session row is already gone.
+    """
+    expired = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_EXPIRES)
+    storage = get_song_storage()
+    backend = get_upload_backend()
+    deleted = 0
+    for session in UploadSession.objects.filter(updated_date_time__lt=expired).iterator():
+        try:
+            if not session.is_completed:
+                backend.abort(session)
+            elif not Song.objects.filter(upload_key=session.key).exists():
+                # Completed but never finalized into a song
+                delete_files(storage, [session.key])
+        except ClientError as error:
+            logger.warning(f"Unable to clean up upload session {session.id}: {error}")
+            continue
+        session.delete()
+        deleted += 1
+    return deleted
+
+
+def parse_content_range(content_range):
+    match = CONTENT_RANGE_PATTERN.match(content_range)
+    if match is None:
+        return None
+    start, end, total = (int(value) for value in match.groups())
+    return (start, end, total) if start <= end < total else None
+
+
+def read_chunk(stream, length):
+    # Chunks larger than a megabyte spill to disk instead of staying in worker memory
+    chunk = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    remaining = length
+    while remaining > 0 and stream is not None:
+        block = stream.read(min(remaining, 64 * 1024))
+        if not block:
+            break
+        chunk.write(block)
+        remaining -= len(block)
+    chunk.seek(0)
+    return chunk, length - remaining
+
+
+def get_upload_backend():
+    return import_string(settings.UPLOAD_SESSION_BACKEND)()
+
+
+class SHA256UploadHandlerMixin:
+    """Hashes uploaded files while they are received, so deduplication does not read them again."""
+
+    def new_file(self, *args, **kwargs):
+        # Set before the parent, which stops the other handlers by raising once it takes the file
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class SHA256MemoryFileUploadHandler(SHA256UploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class SHA256TemporaryFileUploadHandler(SHA256UploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def get_file_sha256(file):
+    sha256 = getattr(file, "sha256", None)
+    if sha256 is None:
+        digest = hashlib.sha256()
+        for block in file.chunks():
+            digest.update(block)
+        sha256 = digest.hexdigest()
+    return sha256
+
+
+def store_song_audio(files):
+    """Maps uploaded files to the AudioBlob of their content, storing new content once.
+
+    Must run in a transaction: the blobs stay locked until it commits, so none is released while a song is created.
+    """
+    storage = get_song_storage()
+    hashes = [get_file_sha256(file) for file in files]
+    audio = AudioBlob.objects.select_for_update().in_bulk(hashes, field_name="sha256")
+    new_files = {sha256: file for sha256, file in zip(hashes, files) if sha256 not in audio}
+    if new_files:
+        # Conflicts with identical audio stored concurrently are ignored, so blobs are read back
+        AudioBlob.objects.bulk_create([
+            AudioBlob(sha256=sha256, size=file.size, location=save_audio_file(storage, sha256, file))
+            for sha256, file in new_files.items()
+        ], ignore_conflicts=True)
+        audio.update(AudioBlob.objects.select_for_update().in_bulk(list(new_files), field_name="sha256"))
+    return [audio[sha256] for sha256 in hashes]
+
+
+def deduplicate_uploaded_song(song_id):
+    """Moves a song finalized from a direct upload to the AudioBlob of its content.
+
+    Runs on a worker, so the bytes of direct uploads never pass through the web servers: the file is hashed from
+    the storage and new content is copied within the storage.
+    """
+    song = Song.objects.filter(id=song_id, audio__isnull=True, upload_key__isnull=False).first()
+    if song is None or song.location.name != song.upload_key:
+        return None
+    storage = get_song_storage()
+    upload_key = song.upload_key
+    size = storage.size(upload_key)
+    digest = hashlib.sha256()
+    for block in read_range(storage, upload_key, 0, size - 1):
+        digest.update(block)
+    sha256 = digest.hexdigest()
+    audio_key = get_audio_key(sha256)
+    # The name is derived from the content, so an existing object already holds the same bytes
+    if not storage.exists(audio_key):
+        copy_file(storage, upload_key, audio_key)
+
+    with transaction.atomic():
+        # The song is locked before the blob, in the same order as Song.delete
+        song = Song.objects.select_for_update().filter(id=song_id, audio__isnull=True).first()
+        AudioBlob.objects.bulk_create([AudioBlob(sha256=sha256, location=audio_key, size=size)], ignore_conflicts=True)
+        audio = AudioBlob.objects.select_for_update().get(sha256=sha256)
+        if song is None or song.location.name != upload_key:
+            # Deleted meanwhile, so the blob may be left without songs
+            is_audio_unused = AudioBlob.release(audio.id)
+        else:
+            is_audio_unused = False
+            song.audio = audio
+            song.location = audio.location.name
+            if song.lyrics is None:
+                # Identical audio was already transcribed for another song
+                song.lyrics = audio.lyrics
+            song.save()
+            transaction.on_commit(lambda: delete_files(storage, [upload_key]))
+    if is_audio_unused:
+        delete_files(storage, [audio.location.name])
+    logger.info(f"Stored the audio of song {song_id} as {audio.location.name}")
+    return audio
+
+
+def copy_file(storage, source_name, name):
+    if hasattr(storage, "bucket"):
+        # S3 copies the object itself instead of it being downloaded and uploaded again
+        extra_args = {"ACL": storage.default_acl} if storage.default_acl else None
+        storage.bucket.Object(name).copy({"Bucket": storage.bucket_name, "Key": source_name}, ExtraArgs=extra_args)
+        return
+    with storage.open(source_name, "rb") as file:
+        storage.save(name, file)
+
+
+def save_audio_file(storage, sha256, file):
+    name = get_audio_key(sha256)
+    # The name is derived from the content, so an existing object already holds the same bytes
+    if storage.exists(name):
+        return name
+    file.seek(0)
+    return storage.save(name, file)
+
+
+def delete_files(storage, names):
+    for name in names:
+        storage.delete(name)
@@ -11,7 +11,9 @@ from .views import (
     PlaylistViewSet,
     RatingViewSet,
     CommentForSongViewSet,
-    CommentForUserViewSet
+    CommentForUserViewSet,
+    LeaderboardViewSet,
+    UploadSessionViewSet
 )
 
 router = routers.DefaultRouter()
@@ -19,11 +21,13 @@ router.register(r"users", UserViewSet)
 router.register(r"songs", SongViewSet)
 router.register(r"artists", ArtistViewSet)
 router.register(r"signup", SignupViewSet, basename="signup")
+router.register(r"leaderboards", LeaderboardViewSet, basename="leaderboard")
 
 users_router = routers.NestedSimpleRouter(router, r"users", lookup="users")
 users_router.register(r"songs", NestedSongViewSet, basename="nested-song")
 users_router.register(r"playlists", PlaylistViewSet, basename="playlist")
 users_router.register(r"comments", CommentForUserViewSet, basename="user-comment")
+users_router.register(r"uploads", UploadSessionViewSet, basename="upload-session")
 
 songs_router = routers.NestedSimpleRouter(router, r"songs", lookup="songs")
 songs_router.register(r"ratings", RatingViewSet, basename="song-rating")
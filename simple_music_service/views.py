@@ -3,10 +3,19 @@ from rest_framework.permissions import AllowAny
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework.response import Response
 from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from django.conf import settings
 from django.urls import reverse
 from django.shortcuts import get_object_or_404
-from django.db.models import Avg
+from django.db import transaction
+from django.db.models import Avg, Count, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
 from .serializers import (
     SongSerializer,
     ArtistSerializer,
@@ -14,57 +23,144 @@ from .serializers import (
     UserSerializer,
     PlaylistSerializer,
     RatingSerializer,
+    PlaylistSongSerializer,
     CommentForSongSerializer,
-    CommentForUserSerializer
+    CommentForUserSerializer,
+    BulkSongSerializer,
+    SongUploadSerializer,
+    UploadSessionSerializer
 )
-from .models import Song, Artist, Playlist, Rating, Comment, ApplicationUser
+from .models import (Song, Artist, Playlist, Rating, Comment, ApplicationUser, UploadSession, SongWaveform,
+                     RecognitionJob)
 from .permissions import IsOwner
+from .mixins import SongResponseCacheMixin, SongFastListMixin, get_sparse_fields
+from .representations import get_song_representation_fields, get_song_rows, get_song_representations
+from .leaderboards import LEADERBOARDS, get_leaderboard
+from .recommendations import get_similar_songs, get_recommended_songs
+from .uploads import create_presigned_upload, get_upload_backend, parse_content_range, read_chunk
+from .renderers import ORJSONRenderer, WaveformRenderer
+from .conditions import (
+    song_list_etag,
+    song_detail_etag,
+    playlist_list_etag,
+    playlist_detail_etag,
+    comment_list_etag,
+    comment_detail_etag,
+    comment_detail_last_modified,
+    song_waveform_etag
+)
 from .paginations import PageNumberAndPageSizePagination
-from .filters import NotNoneValuesLargerOrderingFilter
+from .filters import NotNoneValuesLargerOrderingFilter, SongMetadataFilter
 from .feature_flags import get_feature_flag_value
-from .tasks import recognize_speech_from_file
+from .tasks import request_speech_recognition, record_song_play
+from .streaming import get_song_stream_response, is_new_play
+from .waveforms import get_waveform_peaks
 from django.http import HttpResponse
 from .archive_data import get_archive_with_user_data
 
 
-class SongViewSet(viewsets.ModelViewSet):
+@method_decorator(condition(etag_func=song_list_etag), name="list")
+@method_decorator(condition(etag_func=song_detail_etag), name="retrieve")
+class SongViewSet(SongResponseCacheMixin, SongFastListMixin, viewsets.ModelViewSet):
     queryset = Song.objects.annotate(avg_rating=Avg("rating__mark")).all()
     serializer_class = SongSerializer
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
     http_method_names = ["get"]
-    filter_backends = [SearchFilter, NotNoneValuesLargerOrderingFilter]
+    filter_backends = [SearchFilter, SongMetadataFilter, NotNoneValuesLargerOrderingFilter]
     pagination_class = PageNumberAndPageSizePagination
     search_fields = ["title", "artist__name"]
-    ordering_fields = ["title", "year", "avg_rating"]
+    ordering_fields = ["title", "year", "avg_rating", "duration"]
     ordering = ["-year"]
 
+    def get_queryset(self):
+        fields = get_sparse_fields(self.request, SongSerializer.Meta.fields)
+        return get_song_queryset(fields, ordering=self.request.query_params.get("ordering", ""))
+
     @action(methods=["get"], detail=True, url_path="recognize_speech", url_name="recognize_speech")
     def recognize_speech(self, request, pk=None):
         try:
             song = Song.objects.get(pk=pk)
             if song.lyrics is None:
-                recognize_speech_from_file.delay(song.id)
-                response_status = status.HTTP_202_ACCEPTED
+                job = request_speech_recognition(song.id)
+                job_status, progress = job.status, job.progress
+                if job_status == RecognitionJob.DONE:
+                    # The job finished after the song was read
+                    song.refresh_from_db(fields=["lyrics"])
             else:
-                response_status = status.HTTP_200_OK
-            response_body = {"result_url": reverse("song-detail", args=[song.id])}
-            return Response(response_body, status=response_status)
+                job_status, progress = RecognitionJob.DONE, 100
+            response_body = {
+                "status": job_status,
+                "progress": progress,
+                "result_url": reverse("song-detail", args=[song.id]),
+                "events_url": request.build_absolute_uri(f"{request.path}events/"),
+            }
+            if job_status == RecognitionJob.DONE:
+                response_body["lyrics"] = song.lyrics
+                return Response(response_body, status=status.HTTP_200_OK)
+            return Response(response_body, status=status.HTTP_202_ACCEPTED)
         except Song.DoesNotExist:
             response = {"detail": "Not found."}
             return Response(response, status=status.HTTP_404_NOT_FOUND)
 
+    @action(methods=["get"], detail=True, url_path="stream", url_name="stream")
+    def stream(self, request, pk=None, **kwargs):
+        song = get_object_or_404(Song.objects.only("id", "location"), pk=pk)
+        response = get_song_stream_response(request, song)
+        if is_new_play(request):
+            record_song_play.delay(song.id)
+        return response
+
+    @action(methods=["get"], detail=True, url_path="waveform", url_name="waveform",
+            renderer_classes=[ORJSONRenderer, WaveformRenderer])
+    @method_decorator(cache_control(public=True, max_age=settings.SONG_WAVEFORM_MAX_AGE))
+    @method_decorator(condition(etag_func=song_waveform_etag))
+    def waveform(self, request, pk=None, **kwargs):
+        waveform = get_object_or_404(SongWaveform, song=pk)
+        buckets = get_limit(request, settings.SONG_WAVEFORM_BUCKETS, name="buckets",
+                            default=settings.SONG_WAVEFORM_DEFAULT_BUCKETS)
+        peaks = get_waveform_peaks(waveform, buckets)
+        return Response({"duration": waveform.duration, "buckets": len(peaks), "peaks": peaks.ravel().tolist()})
 
+    @action(methods=["get"], detail=True, url_path="similar", url_name="similar")
+    def similar(self, request, pk=None, **kwargs):
+        scores = get_similar_songs(pk, get_limit(request, settings.RECOMMENDATION_NEIGHBOURS))
+        return Response(get_scored_songs(request, scores))
+
+
+@method_decorator(condition(etag_func=song_detail_etag), name="retrieve")
 class NestedSongViewSet(SongViewSet):
     http_method_names = ["get", "post", "delete"]
     permission_classes = (IsOwner,)
 
     def get_queryset(self):
-        return Song.objects.annotate(avg_rating=Avg("rating__mark")).filter(user=self.kwargs["users_pk"])
+        return super().get_queryset().filter(user=self.kwargs["users_pk"])
 
     def retrieve(self, request, pk=None, users_pk=None):
-        item = get_object_or_404(self.queryset, pk=pk, user=users_pk)
+        item = get_object_or_404(self.get_queryset(), pk=pk)
         serializer = self.get_serializer(item)
         return Response(serializer.data)
 
+    @action(methods=["post"], detail=False, url_path="bulk", url_name="bulk")
+    def bulk(self, request, users_pk=None):
+        serializer = BulkSongSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        songs = serializer.save()["songs"]
+        fields = get_song_representation_fields(SongSerializer.Meta.fields)
+        queryset = get_song_queryset(fields).filter(pk__in=[song.id for song in songs]).order_by("id")
+        rows = get_song_rows(queryset, fields)
+        return Response(get_song_representations(rows, fields, request), status=status.HTTP_201_CREATED)
+
+    @action(methods=["post"], detail=False, url_path="upload_url", url_name="upload_url")
+    def upload_url(self, request, users_pk=None):
+        return Response(create_presigned_upload(request.user.id), status=status.HTTP_201_CREATED)
+
+    @action(methods=["post"], detail=False, url_path="finalize_upload", url_name="finalize_upload")
+    def finalize_upload(self, request, users_pk=None):
+        serializer = SongUploadSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     def destroy(self, request, *args, **kwargs):
         is_delete_song_available = get_feature_flag_value("isDeleteSongAvailable")
         if is_delete_song_available:
@@ -104,7 +200,15 @@ class UserViewSet(viewsets.ModelViewSet):
         response["Content-Disposition"] = "attachment; filename=data.zip"
         return response
 
+    @action(methods=["get"], detail=True, url_path="recommendations", url_name="recommendations",
+            permission_classes=[IsOwner])
+    def recommendations(self, request, pk=None):
+        scores = get_recommended_songs(pk, get_limit(request, settings.RECOMMENDATION_SIZE))
+        return Response(get_scored_songs(request, scores))
+
 
+@method_decorator(condition(etag_func=playlist_list_etag), name="list")
+@method_decorator(condition(etag_func=playlist_detail_etag), name="retrieve")
 class PlaylistViewSet(viewsets.ModelViewSet):
     queryset = Playlist.objects.all()
     serializer_class = PlaylistSerializer
@@ -116,10 +220,14 @@ class PlaylistViewSet(viewsets.ModelViewSet):
     ordering = ["title"]
 
     def get_queryset(self):
-        return Playlist.objects.filter(user=self.kwargs["users_pk"])
+        queryset = Playlist.objects.filter(user=self.kwargs["users_pk"])
+        if "song" in get_sparse_fields(self.request, PlaylistSerializer.Meta.fields):
+            songs = get_song_queryset(PlaylistSongSerializer.Meta.fields)
+            queryset = queryset.prefetch_related(Prefetch("song", queryset=songs))
+        return queryset
 
     def retrieve(self, request, pk=None, users_pk=None):
-        item = get_object_or_404(self.queryset, pk=pk, user=users_pk)
+        item = get_object_or_404(self.get_queryset(), pk=pk)
         serializer = self.get_serializer(item)
         return Response(serializer.data)
 
@@ -132,6 +240,10 @@ class RatingViewSet(viewsets.ModelViewSet):
         return Rating.objects.filter(song=self.kwargs["songs_pk"])
 
 
+# No Last-Modified for the list: deleting the newest comment would move it back to a date clients already cached
+@method_decorator(condition(etag_func=comment_list_etag), name="list")
+@method_decorator(condition(etag_func=comment_detail_etag, last_modified_func=comment_detail_last_modified),
+                  name="retrieve")
 class CommentForSongViewSet(viewsets.ModelViewSet):
     serializer_class = CommentForSongSerializer
     pagination_class = PageNumberAndPageSizePagination
@@ -140,7 +252,10 @@ class CommentForSongViewSet(viewsets.ModelViewSet):
     ordering = ["created_date_time"]
 
     def get_queryset(self):
-        return Comment.objects.filter(song=self.kwargs["songs_pk"])
+        queryset = Comment.objects.filter(song=self.kwargs["songs_pk"])
+        if "user" in get_sparse_fields(self.request, CommentForSongSerializer.Meta.fields):
+            queryset = queryset.select_related("user")
+        return queryset
 
 
 class CommentForUserViewSet(viewsets.ModelViewSet):
@@ -153,4 +268,140 @@ class CommentForUserViewSet(viewsets.ModelViewSet):
     ordering = ["created_date_time"]
 
     def get_queryset(self):
-        return Comment.objects.filter(user=self.kwargs["users_pk"])
+        queryset = Comment.objects.filter(user=self.kwargs["users_pk"])
+        if "song" in get_sparse_fields(self.request, CommentForUserSerializer.Meta.fields):
+            songs = get_song_queryset(SongSerializer.Meta.fields)
+            queryset = queryset.prefetch_related(Prefetch("song", queryset=songs))
+        return queryset
+
+
+class UploadSessionViewSet(viewsets.ModelViewSet):
+    serializer_class = UploadSessionSerializer
+    http_method_names = ["get", "post", "put", "delete"]
+    permission_classes = (IsOwner,)
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.kwargs["users_pk"])
+
+    def update(self, request, pk=None, users_pk=None):
+        content_range = parse_content_range(request.headers.get("Content-Range", ""))
+        if content_range is None:
+            response = {"detail": "Content-Range header must be \"bytes <start>-<end>/<size>\"."}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+        start, end, size = content_range
+        length = end - start + 1
+
+        backend = get_upload_backend()
+        session = get_object_or_404(self.get_queryset(), pk=pk)
+        if session.is_completed or size != session.size:
+            response = {"detail": "Upload session does not accept this range."}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+        if start != session.offset:
+            return self.get_offset_conflict_response(session)
+        if length > settings.UPLOAD_CHUNK_MAX_SIZE or (end + 1 < size and length < backend.min_part_size):
+            response = {"detail": f"Chunks must be at most {settings.UPLOAD_CHUNK_MAX_SIZE} bytes, and all but "
+                                  f"the last at least {backend.min_part_size} bytes."}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+
+        # No row lock is held while the chunk is received and stored, which can take as long as the client needs
+        chunk, received = read_chunk(request.stream, length)
+        with chunk:
+            if received != length:
+                response = {"detail": "Chunk is shorter than its Content-Range.", "offset": session.offset}
+                return Response(response, status=status.HTTP_400_BAD_REQUEST)
+            part_number = len(session.parts) + 1
+            etag = backend.upload_part(session, part_number, chunk)
+        session.parts.append({"PartNumber": part_number, "ETag": etag})
+        # Only the first of concurrent requests for the same range moves the offset, the others get a conflict.
+        # They wrote the same part number, which a client retrying the range fills with the same bytes and ETag.
+        updated = self.get_queryset().filter(pk=pk, offset=start, is_completed=False).update(
+            offset=end + 1, parts=session.parts, updated_date_time=timezone.now())
+        if not updated:
+            return self.get_offset_conflict_response(get_object_or_404(self.get_queryset(), pk=pk))
+        session.offset = end + 1
+        return Response(self.get_serializer(session).data)
+
+    @staticmethod
+    def get_offset_conflict_response(session):
+        response = {"detail": "Chunk does not start at the current offset.", "offset": session.offset}
+        return Response(response, status=status.HTTP_409_CONFLICT)
+
+    def destroy(self, request, pk=None, users_pk=None):
+        session = get_object_or_404(self.get_queryset(), pk=pk)
+        if not session.is_completed:
+            get_upload_backend().abort(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(methods=["post"], detail=True, url_path="complete", url_name="complete")
+    def complete(self, request, pk=None, users_pk=None):
+        with transaction.atomic():
+            session = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            if session.offset != session.size:
+                response = {"detail": "Upload is not finished.", "offset": session.offset}
+                return Response(response, status=status.HTTP_409_CONFLICT)
+            if not session.is_completed:
+                session.key = get_upload_backend().complete(session)
+                session.is_completed = True
+                session.save()
+
+        data = request.data.copy()
+        data["location"] = session.key
+        serializer = SongUploadSerializer(data=data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class LeaderboardViewSet(viewsets.ViewSet):
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
+
+    def list(self, request):
+        return Response([{"name": name, "url": request.build_absolute_uri(reverse("leaderboard-detail", args=[name]))}
+                         for name in LEADERBOARDS])
+
+    def retrieve(self, request, pk=None):
+        if pk not in LEADERBOARDS:
+            raise NotFound()
+        scores = get_leaderboard(pk, get_limit(request, settings.LEADERBOARD_SIZE))
+        return Response({"name": pk, "results": get_scored_songs(request, scores)})
+
+
+def get_limit(request, maximum, *, name="limit", default=None):
+    default = maximum if default is None else default
+    try:
+        return max(min(int(request.query_params.get(name, default)), maximum), 0)
+    except ValueError:
+        return default
+
+
+def get_scored_songs(request, scores):
+    scores = dict(scores)
+    fields = get_song_representation_fields(get_sparse_fields(request, SongSerializer.Meta.fields))
+    rows = get_song_rows(get_song_queryset(fields).filter(pk__in=scores), fields)
+    songs = {row["id"]: row for row in rows}
+    ranked_rows = [songs[song_id] for song_id in scores if song_id in songs]
+    return [dict(song, score=scores[row["id"]])
+            for song, row in zip(get_song_representations(ranked_rows, fields, request), ranked_rows)]
+
+
+def get_song_queryset(fields, *, ordering=""):
+    queryset = Song.objects.all()
+    annotations = {}
+    if "average_rating" in fields or "avg_rating" in ordering:
+        annotations["avg_rating"] = Avg("rating__mark")
+    if "reviews_count" in fields:
+        annotations["rating_count"] = Count("rating", distinct=True)
+    if "comments_count" in fields:
+        comments_count = Comment.objects.filter(song=OuterRef("pk")).order_by().values("song") \
+            .annotate(count=Count("id")).values("count")
+        annotations["comment_count"] = Coalesce(Subquery(comments_count), 0)
+    if annotations:
+        queryset = queryset.annotate(**annotations)
+    if "artist" in fields:
+        queryset = queryset.prefetch_related("artist")
+    if "renditions" in fields:
+        queryset = queryset.prefetch_related("renditions")
+    if "lyrics" not in fields:
+        queryset = queryset.defer("lyrics")
+    return queryset
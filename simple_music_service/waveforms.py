@@ -0,0 +1,51 @@
+import logging
+import numpy as np
+from django.conf import settings
+from pydub import AudioSegment
+from .models import Song, SongWaveform
+
+logger = logging.getLogger("django")
+
+
+def compute_song_waveform(song_id):
+    try:
+        song = Song.objects.get(id=song_id)
+    except Song.DoesNotExist:
+        logger.info(f"Song {song_id} was deleted before computing its waveform")
+        return None
+
+    # Songs with identical audio have identical waveforms
+    shared_waveform = SongWaveform.objects.filter(song__audio=song.audio_id).exclude(song=song) \
+        .values("duration", "peaks").first() if song.audio_id else None
+    if shared_waveform is not None:
+        waveform, _ = SongWaveform.objects.update_or_create(song=song, defaults=shared_waveform)
+        return waveform
+
+    with song.location.open("rb") as file:
+        # A forced decoder skips the ffprobe round trip, and a mono mix halves the samples to scan
+        sound = AudioSegment.from_file(file, format="mp3", codec="mp3", parameters=["-ac", "1"])
+    samples = np.frombuffer(sound.raw_data, dtype=f"<i{sound.sample_width}")
+    peaks = get_peaks(samples, settings.SONG_WAVEFORM_BUCKETS) / float(2 ** (8 * sound.sample_width - 1))
+
+    waveform, _ = SongWaveform.objects.update_or_create(song=song, defaults={
+        "duration": len(sound),
+        "peaks": np.round(peaks * 127).astype(np.int8).tobytes(),
+    })
+    return waveform
+
+
+def get_peaks(samples, buckets):
+    """Returns a (buckets, 2) array of min/max pairs; samples may also be an existing peaks array to downsample."""
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        samples = np.stack([samples, samples], axis=1)
+    buckets = max(min(buckets, len(samples)), 1)
+    if not len(samples):
+        return np.zeros((0, 2), dtype=samples.dtype)
+    starts = np.linspace(0, len(samples), buckets, endpoint=False).astype(np.intp)
+    return np.stack([np.minimum.reduceat(samples[:, 0], starts), np.maximum.reduceat(samples[:, 1], starts)], axis=1)
+
+
+def get_waveform_peaks(waveform, buckets):
+    peaks = np.frombuffer(bytes(waveform.peaks), dtype=np.int8).reshape(-1, 2)
+    return get_peaks(peaks, buckets)